@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Analyzes a folder of images for droplets from the command line, like
+dropletAnalysisGUI but without any windows, so it can be run over SSH or in
+a scheduled job. The output is the same: images showing the droplets found,
+and a .csv file (dropletData.csv by default) of all of the droplets, which
+is written as the images are analyzed.
+
+    python dropletAnalysisCLI.py imgs results --type tif --workers 4 --cache
+
+A line is printed for every image as it is analyzed. The exit status is
+0 if every image was analyzed, 1 if the analysis failed, 2 if the arguments
+are bad and 3 if there were no images to analyze.
+
+With --watch, the input folder is instead watched for new images while they
+are acquired (see dropletAnalysisFuncs.iterWatchFolder), and their rows are
+appended to the .csv file as they are analyzed, until Ctrl+C or until
+nothing changed for --idle-timeout seconds. Images already in the .csv file
+are not analyzed again.
+
+    python dropletAnalysisCLI.py imgs results --watch --workers 2
+
+With --mosaic, each image is instead analyzed in tiles (see 
+dropletAnalysisFuncs.analyzeMosaic), for stitched images of the device too
+large to analyze at once. --workers is then the number of processes the
+tiles of each image are analyzed in.
+
+    python dropletAnalysisCLI.py stitched results --type tif --mosaic --tile-size 2048
+
+Needs to import dropletAnalysisFuncs.py; does not need tkinter or
+matplotlib.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import dropletAnalysisFuncs as daf
+
+#exit statuses
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_NO_IMAGES = 3
+
+def makeParser():
+    parser = argparse.ArgumentParser(description = "Analyze a folder of images for droplets.")
+    parser.add_argument("inputDir", help = "folder of images to analyze")
+    parser.add_argument("outputDir", help = "folder to write the output images and .csv file to")
+    parser.add_argument("--type", dest = "imgType", default = "png",
+                        help = "extension of the images to analyze, e.g. png, jpg, tif (default: png)")
+
+    detection = parser.add_argument_group("detection")
+    detection.add_argument("--min-r", dest = "minR", type = int, default = 5,
+                           help = "smallest droplet radius, in pixels (default: 5)")
+    detection.add_argument("--max-r", dest = "maxR", type = int, default = 30,
+                           help = "largest droplet radius, in pixels (default: 30)")
+    detection.add_argument("--dp", type = float, default = 1,
+                           help = "inverse accumulator resolution of HoughCircles (default: 1)")
+    detection.add_argument("--p1", type = float, default = 15,
+                           help = "param1 of HoughCircles (default: 15)")
+    detection.add_argument("--p2", type = float, default = 15,
+                           help = "param2 of HoughCircles (default: 15)")
+    detection.add_argument("--detector", default = "hough", choices = list(daf.DETECTORS.keys()),
+                           help = "droplet detector (default: hough)")
+    detection.add_argument("--max-refilter", dest = "maxRefilter", type = int, default = 20,
+                           help = "most times an image is re-thresholded (default: 20)")
+    detection.add_argument("--no-prescreen", dest = "prescreen", action = "store_false",
+                           help = "analyze empty, saturated and out of focus images too")
+    detection.add_argument("--saturation", type = int,
+                           help = "value at which the camera saturates, e.g. 4095 for a 12-bit camera "
+                                  "(default: the largest value of the image type)")
+
+    run = parser.add_argument_group("run")
+    run.add_argument("--workers", type = int, default = 1,
+                     help = "processes to analyze images in; 0 uses one per CPU (default: 1)")
+    run.add_argument("--prefetch", type = int, default = 2,
+                     help = "images read ahead of the analysis with 1 worker (default: 2)")
+    run.add_argument("--cache", action = "store_true",
+                     help = "reuse the results of images analyzed before with the same parameters")
+    run.add_argument("--cache-folder", dest = "cacheFolder",
+                     help = "folder of the cache (default: dropletCache in the input folder)")
+
+    output = parser.add_argument_group("output")
+    output.add_argument("--csv", dest = "csvName", default = "dropletData",
+                        help = "name of the .csv file in the output folder (default: dropletData)")
+    output.add_argument("--append", action = "store_true",
+                        help = "add the rows to an existing .csv file instead of replacing it")
+    output.add_argument("--debug", action = "store_true",
+                        help = "write the images of every step, each image in its own folder")
+    output.add_argument("--png-compression", dest = "pngCompression", type = int,
+                        choices = range(10), metavar = "0-9",
+                        help = "PNG compression level of the output images (default: OpenCV's)")
+    output.add_argument("--writer-threads", dest = "writerThreads", type = int, default = 2,
+                        help = "threads writing the output images; 0 writes them in line (default: 2)")
+    output.add_argument("--profile", action = "store_true",
+                        help = "time every stage, and write the timings next to the .csv file")
+
+    mosaic = parser.add_argument_group("mosaic")
+    mosaic.add_argument("--mosaic", action = "store_true",
+                        help = "analyze each image in tiles, for images too large to analyze at once")
+    mosaic.add_argument("--tile-size", dest = "tileSize", type = int, default = 2048,
+                        help = "size of the tiles, in pixels (default: 2048)")
+    mosaic.add_argument("--halo", type = int,
+                        help = "pixels around each tile analyzed with it, at least max-r (default: 2 * max-r)")
+    mosaic.add_argument("--overview-size", dest = "overviewSize", type = int, default = 4096,
+                        help = "longest side of the output image of a mosaic, in pixels (default: 4096)")
+
+    watch = parser.add_argument_group("watch")
+    watch.add_argument("--watch", action = "store_true",
+                       help = "keep analyzing new images as they are written to the input folder")
+    watch.add_argument("--interval", type = float, default = 1.0,
+                       help = "seconds between looking for new images (default: 1)")
+    watch.add_argument("--settle", type = float, default = 1.0,
+                       help = "seconds an image must stay unchanged to be complete (default: 1)")
+    watch.add_argument("--idle-timeout", dest = "idleTimeout", type = float,
+                       help = "stop once nothing changed for this many seconds (default: never)")
+    return parser
+
+def checkArgs(parser, args):
+    """Checks the arguments like dropletAnalysisGUI does, exiting through
+    parser.error (status 2) if they are bad."""
+    if(not os.path.isdir(args.inputDir)):
+        parser.error("input folder {} does not exist".format(args.inputDir))
+    if(os.path.realpath(args.inputDir) == os.path.realpath(args.outputDir)):
+        parser.error("input and output folders must be different")
+
+    for name in ["minR", "maxR", "dp", "p1", "p2"]:
+        if(getattr(args, name) <= 0):
+            parser.error("{} must be positive".format(name))
+    if(args.saturation is not None and args.saturation <= 0):
+        parser.error("saturation must be positive")
+    if(args.minR > args.maxR):
+        parser.error("minR must not be larger than maxR")
+    if(args.workers < 0 or args.prefetch < 0 or args.writerThreads < 0):
+        parser.error("workers, prefetch and writer-threads can't be negative")
+    if(args.interval <= 0 or args.settle < 0):
+        parser.error("interval must be positive, and settle can't be negative")
+    if(args.watch and (args.cache or args.profile)):
+        parser.error("--cache and --profile can't be used with --watch")
+    if(args.mosaic and (args.watch or args.cache or args.debug)):
+        parser.error("--watch, --cache and --debug can't be used with --mosaic")
+    if(args.tileSize <= 0 or args.overviewSize <= 0):
+        parser.error("tile-size and overview-size must be positive")
+    if(args.halo is not None and args.halo < args.maxR):
+        parser.error("halo must be at least max-r")
+
+def progressLine(done, total, image, seconds):
+    """Returns the line printed once an Image is analyzed. total is None
+    if it isn't known (when watching)."""
+    if(image.getStatus() == "ok"):
+        found = "{} droplets".format(len(image.getDroplets()))
+    else:
+        found = "rejected ({})".format(image.getStatus())
+
+    count = "{}".format(done) if total is None else "{}/{}".format(done, total)
+    return "[{}] {}: {} ({:.1f} images/s)".format(count, image.getName(),
+                                                  found, done / max(seconds, 1e-9))
+
+def iterMosaics(args, files, report = None):
+    """Analyzes each of files (the first page of TIFF stacks) with 
+    analyzeMosaic, as described by the parsed args, and yields the 
+    Images."""
+    with daf.ImageWriter(args.writerThreads, pngCompression = args.pngCompression) as writer:
+        for fn in files:
+            image = daf.analyzeMosaic(fn, args.outputDir, args.imgType,
+                                      args.minR, args.maxR, args.dp, args.p1, args.p2,
+                                      tileSize = args.tileSize, halo = args.halo,
+                                      workers = args.workers if args.workers > 0 else None,
+                                      maxRefilter = args.maxRefilter,
+                                      prescreen = args.prescreen,
+                                      detector = args.detector,
+                                      overviewSize = args.overviewSize,
+                                      writer = writer, profile = args.profile,
+                                      saturation = args.saturation)
+            if(report is not None):
+                report.add(image)
+            yield image
+
+def run(args):
+    """Analyzes the folder described by the parsed args, printing a line
+    for every image.
+
+    RETURNS:
+        exit status
+    """
+    files, images = daf.folderImages(args.inputDir, args.imgType)
+    if(args.mosaic):
+        images = files
+    if(len(images) == 0):
+        print("No .{} images in {}".format(args.imgType, args.inputDir), file = sys.stderr)
+        return EXIT_NO_IMAGES
+
+    os.makedirs(args.outputDir, exist_ok = True)
+    csvPath = os.path.join(args.outputDir, args.csvName)
+
+    report = daf.RunReport() if args.profile else None
+    rejected = 0
+    start = time.perf_counter()
+
+    if(args.mosaic):
+        analyzed = iterMosaics(args, files, report)
+    else:
+        analyzed = daf.iterAnalyzeFolder(args.inputDir, args.outputDir, args.imgType,
+                                         args.minR, args.maxR, args.dp, args.p1, args.p2,
+                                         debug = args.debug,
+                                         workers = args.workers if args.workers > 0 else None,
+                                         writerThreads = args.writerThreads,
+                                         pngCompression = args.pngCompression,
+                                         cache = args.cache, cacheFolder = args.cacheFolder,
+                                         report = report,
+                                         maxRefilter = args.maxRefilter,
+                                         prescreen = args.prescreen,
+                                         detector = args.detector,
+                                         prefetch = args.prefetch,
+                                         saturation = args.saturation)
+
+    try:
+        with daf.DropletWriter(csvPath, append = args.append) as writer:
+            for i, image in enumerate(analyzed):
+                writer.write(image)
+                if(image.getStatus() != "ok"):
+                    rejected += 1
+
+                print(progressLine(i + 1, len(images), image, time.perf_counter() - start))
+    except KeyboardInterrupt:
+        print("Interrupted; {}.csv has the images analyzed so far".format(csvPath), file = sys.stderr)
+        return EXIT_FAILED
+    except Exception as e:
+        print("ERROR: {}: {}".format(type(e).__name__, e), file = sys.stderr)
+        return EXIT_FAILED
+
+    if(report is not None):
+        report.write("{}-timings".format(csvPath))
+
+    print("Done: {} images ({} rejected) in {:.1f} s, written to {}.csv".format(
+        len(images), rejected, time.perf_counter() - start, csvPath))
+    return EXIT_OK
+
+def watch(args):
+    """Watches the input folder described by the parsed args, appending the
+    rows of every new image to the .csv file and printing a line for it.
+
+    RETURNS:
+        exit status
+    """
+    os.makedirs(args.outputDir, exist_ok = True)
+    csvPath = os.path.join(args.outputDir, args.csvName)
+
+    #images analyzed in an earlier (e.g. interrupted) run
+    skip = set()
+    if(os.path.exists(csvPath + ".csv")):
+        skip = daf.csvImageNames(csvPath + ".csv")
+
+    done = 0
+    start = time.perf_counter()
+
+    try:
+        with daf.DropletWriter(csvPath, append = True) as writer:
+            for image in daf.iterWatchFolder(args.inputDir, args.outputDir, args.imgType,
+                                             args.minR, args.maxR, args.dp, args.p1, args.p2,
+                                             debug = args.debug,
+                                             workers = args.workers if args.workers > 0 else None,
+                                             writerThreads = args.writerThreads,
+                                             pngCompression = args.pngCompression,
+                                             maxRefilter = args.maxRefilter,
+                                             prescreen = args.prescreen,
+                                             detector = args.detector,
+                                             saturation = args.saturation,
+                                             interval = args.interval,
+                                             settle = args.settle,
+                                             idleTimeout = args.idleTimeout,
+                                             skip = skip):
+                writer.write(image)
+                done += 1
+                print(progressLine(done, None, image, time.perf_counter() - start))
+    except KeyboardInterrupt:
+        #the usual way to stop watching
+        pass
+    except Exception as e:
+        print("ERROR: {}: {}".format(type(e).__name__, e), file = sys.stderr)
+        return EXIT_FAILED
+
+    print("Stopped watching: {} images in {:.1f} s, written to {}.csv".format(
+        done, time.perf_counter() - start, csvPath))
+    return EXIT_OK
+
+def main(argv = None):
+    parser = makeParser()
+    args = parser.parse_args(argv)
+    checkArgs(parser, args)
+
+    #print progress as it happens, even into a log file
+    sys.stdout.reconfigure(line_buffering = True)
+
+    return watch(args) if args.watch else run(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
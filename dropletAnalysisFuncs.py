@@ -10,30 +10,75 @@ Imported by dropletAnalysisGUI, but can be used independently.
 """
 
 import cv2 as cv
-from matplotlib import pyplot as plt
 import numpy as np
 import os
 from glob import glob
 import csv
-
-#change the working directory
-os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from itertools import repeat, count
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
+from collections import OrderedDict, deque
+import threading
+import hashlib
+import json
+import shutil
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from histogramFuncs import Histogram
+from tiffFuncs import openImage, readPages, frameCount, readFrame, TiffError
 
 #################### CLASSES ####################
 
+#one row of a DropletTable
+DROPLET_DTYPE = np.dtype([("x", "int32"), ("y", "int32"), ("r", "int32"),
+                          ("mean", "float64"), ("imageID", "int32"),
+                          ("discMean", "float64"), ("discMedian", "float64"),
+                          ("discStd", "float64"), ("integrated", "float64"),
+                          ("max", "float64"), ("saturated", "int32")])
+
+#the columns of DROPLET_DTYPE made by dropletStats
+STATS_COLUMNS = ["discMean", "discMedian", "discStd", "integrated", "max", "saturated"]
+
 class Droplet:
-    #represents a single droplet, with x, y position, r radius, and a mean
+    #represents a single droplet, with x, y position, r radius, and a mean.
+    #It is a view of one row of a DropletTable; a Droplet made on its own
+    #gets a one-row table.
     def __init__(self, x, y, r, mean = -1):
-        self.x = x
-        self.y = y
-        self.r = r
-        self.mean = mean
+        self.rows = np.zeros(1, dtype = DROPLET_DTYPE)
+        self.rows[["x", "y", "r", "mean", "imageID"]] = (x, y, r, mean, -1)
+        self.index = 0
+    
+    @classmethod
+    def view(cls, rows, index):
+        #a Droplet for row index of the structured array rows
+        droplet = cls.__new__(cls)
+        droplet.rows = rows
+        droplet.index = index
+        return droplet
         
     def __repr__(self):
         return "<Droplet ({x}, {y}, {r})>".format(x = self.x, y = self.y, r = self.r)
     
+    @property
+    def x(self):
+        return int(self.rows["x"][self.index])
+    
+    @property
+    def y(self):
+        return int(self.rows["y"][self.index])
+    
+    @property
+    def r(self):
+        return int(self.rows["r"][self.index])
+    
+    @property
+    def mean(self):
+        return float(self.rows["mean"][self.index])
+    
     def setMean(self, newMean):
-        self.mean = newMean
+        self.rows["mean"][self.index] = newMean
         
     def getXstr(self):
         return str(self.x)
@@ -47,21 +92,267 @@ class Droplet:
     def getMean(self):
         return self.mean
 
+class DropletTable:
+    #the droplets of an Image (or of a whole ImageCollection) as the columns
+    #of a NumPy structured array with DROPLET_DTYPE. Indexing and iterating
+    #give Droplet views of the rows, so it can be used like a list of Droplets.
+    def __init__(self, data = None):
+        if(data is None):
+            data = np.zeros(0, dtype = DROPLET_DTYPE)
+        self.data = data
+    
+    @classmethod
+    def fromCircles(cls, circles, means, imageID = -1, stats = None):
+        #a table from a list of (x, y, r) circles and their means, and
+        #optionally their dropletStats
+        data = np.zeros(len(circles), dtype = DROPLET_DTYPE)
+        
+        if(len(circles) > 0):
+            circles = np.asarray(circles).reshape(-1, 3)
+            data["x"] = circles[:, 0]
+            data["y"] = circles[:, 1]
+            data["r"] = circles[:, 2]
+            data["mean"] = means
+            if(stats is not None):
+                for name in STATS_COLUMNS:
+                    data[name] = stats[name]
+        data["imageID"] = imageID
+        
+        return cls(data)
+    
+    @classmethod
+    def fromDroplets(cls, droplets):
+        #a table from a list of Droplets
+        return cls.fromCircles([(d.x, d.y, d.r) for d in droplets],
+                               [d.mean for d in droplets])
+    
+    @classmethod
+    def concatenate(cls, tables):
+        if(len(tables) == 0):
+            return cls()
+        return cls(np.concatenate([table.data for table in tables]))
+    
+    def __repr__(self):
+        return "<DropletTable of {} droplets>".format(len(self))
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __getitem__(self, i):
+        if(i < 0):
+            i += len(self.data)
+        if(not 0 <= i < len(self.data)):
+            raise IndexError("DropletTable index out of range")
+        return Droplet.view(self.data, i)
+    
+    def __iter__(self):
+        for i in range(len(self.data)):
+            yield Droplet.view(self.data, i)
+    
+    def column(self, name):
+        return self.data[name]
+    
+    def setImageID(self, imageID):
+        self.data["imageID"] = imageID
+
+class StepCache:
+    #a bounded LRU cache of RGB step images, shared by every StepStore. The
+    #least recently used steps are dropped once more than maxBytes are held.
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.nBytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def __repr__(self):
+        return "<StepCache of {} steps ({} bytes)>".format(len(self.entries), self.nBytes)
+    
+    def get(self, key):
+        with self.lock:
+            img = self.entries.get(key)
+            if(img is not None):
+                self.entries.move_to_end(key)
+            return img
+    
+    def put(self, key, img):
+        with self.lock:
+            if(key in self.entries):
+                self.nBytes -= self.entries.pop(key).nbytes
+            
+            self.entries[key] = img
+            self.nBytes += img.nbytes
+            
+            #always keep the newest step, even if it is bigger than maxBytes
+            while(self.nBytes > self.maxBytes and len(self.entries) > 1):
+                oldKey, oldImg = self.entries.popitem(last = False)
+                self.nBytes -= oldImg.nbytes
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nBytes = 0
+
+#cache of converted steps for all Images
+STEP_CACHE = StepCache(maxBytes = 512 * 2 ** 20)
+
+class BufferArena:
+    #reusable scratch images for analyzeFrame, keyed by name, shape and
+    #dtype, so a folder of same-sized frames doesn't allocate new ones for
+    #every frame. A buffer is only good until it is asked for again, so
+    #nothing taken from an arena may be kept. The least recently used
+    #buffers are dropped once more than maxBytes are held.
+    #savedBytes counts the bytes that were reused instead of allocated.
+    #Not thread-safe; every thread has its own (see threadArena).
+    def __init__(self, maxBytes = 256 * 2 ** 20):
+        self.maxBytes = maxBytes
+        self.nBytes = 0
+        self.buffers = OrderedDict()
+        self.allocatedBytes = 0
+        self.savedBytes = 0
+
+    def __repr__(self):
+        return "<BufferArena of {} buffers ({} bytes), saved {} bytes>".format(
+            len(self.buffers), self.nBytes, self.savedBytes)
+
+    def empty(self, name, shape, dtype = "uint8"):
+        #an uninitialized buffer
+        key = (name, tuple(shape), np.dtype(dtype).str)
+        buf = self.buffers.get(key)
+
+        if(buf is not None):
+            self.buffers.move_to_end(key)
+            self.savedBytes += buf.nbytes
+            return buf
+
+        buf = np.empty(shape, dtype = dtype)
+        self.buffers[key] = buf
+        self.nBytes += buf.nbytes
+        self.allocatedBytes += buf.nbytes
+
+        #always keep the newest buffer, even if it is bigger than maxBytes
+        while(self.nBytes > self.maxBytes and len(self.buffers) > 1):
+            oldKey, oldBuf = self.buffers.popitem(last = False)
+            self.nBytes -= oldBuf.nbytes
+
+        return buf
+
+    def zeros(self, name, shape, dtype = "uint8"):
+        #a buffer filled with zeros, like np.zeros
+        buf = self.empty(name, shape, dtype)
+        buf.fill(0)
+        return buf
+
+    def like(self, name, img, dtype = None):
+        #an uninitialized buffer of the shape (and dtype) of img
+        return self.empty(name, img.shape, img.dtype if dtype is None else dtype)
+
+    def stats(self):
+        return {"buffers": len(self.buffers), "heldBytes": self.nBytes,
+                "allocatedBytes": self.allocatedBytes, "savedBytes": self.savedBytes}
+
+    def clear(self):
+        self.buffers.clear()
+        self.nBytes = 0
+
+#the BufferArena of each thread
+THREAD_ARENAS = threading.local()
+
+def threadArena():
+    """Returns the BufferArena of the calling thread (so of each worker, too),
+    making it the first time."""
+    arena = getattr(THREAD_ARENAS, "arena", None)
+    if(arena is None):
+        arena = BufferArena()
+        THREAD_ARENAS.arena = arena
+    return arena
+
+class StepStore:
+    #the step images of an Image, by name. A step is only converted to RGB 
+    #when it is first asked for. Until a step has been written to its path,
+    #the store holds the unconverted image; after written() is called, it is
+    #read back from the path instead. Converted steps go in STEP_CACHE.
+    storeIDs = count()
+    
+    def __init__(self, steps = None, paths = None):
+        self.raw = dict(steps) if steps is not None else {}
+        self.paths = dict(paths) if paths is not None else {}
+        self.names = list(self.raw.keys()) + [name for name in self.paths if name not in self.raw]
+        #identifies this store's entries in STEP_CACHE
+        self.storeID = next(StepStore.storeIDs)
+    
+    def __repr__(self):
+        return "<StepStore of {}>".format(", ".join(self.names))
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def __iter__(self):
+        return iter(list(self.names))
+    
+    def __contains__(self, name):
+        return name in self.names
+    
+    def keys(self):
+        return list(self.names)
+    
+    def __getitem__(self, name):
+        if(name not in self.names):
+            raise KeyError(name)
+        
+        img = STEP_CACHE.get((self.storeID, name))
+        
+        if(img is None):
+            img = self.raw.get(name)
+            if(img is None):
+                img = cv.imread(self.paths[name], cv.IMREAD_UNCHANGED)
+                if(img is None):
+                    raise IOError("Could not read step {} from {}".format(name, self.paths[name]))
+            
+            #make sure all images are in RGB format
+            if(len(img.shape) == 3):
+                img = cv.cvtColor(img, cv.COLOR_BGR2RGB)
+            else:
+                img = cv.cvtColor(img, cv.COLOR_GRAY2RGB)
+            
+            STEP_CACHE.put((self.storeID, name), img)
+        
+        return img
+    
+    def written(self, name):
+        #the step has been written to its path, so stop holding it in memory
+        if(name in self.paths):
+            self.raw.pop(name, None)
+    
+    def allWritten(self):
+        return len(self.raw) == 0
+
 class Image:
     #represents a taken image. Contains a name, median, droplets, and steps, 
-    #which are images of the process
-    def __init__(self, name, droplets, median, steps):
+    #which are images of the process. paths holds where each step was written.
+    #droplets is a DropletTable (a list of Droplets is converted to one), and
+    #steps is a StepStore (a dict of images is converted to one). timings are
+    #the stage timings from a StageTimer, if the analysis was profiled.
+    #refilterCount is how many times the image was re-filtered because it was
+    #too noisy, and refilterTime how many seconds that took. status is "ok",
+    #or why the image was rejected without being analyzed (see screenFrame).
+    #frame is the index of the image in its TIFF stack, or None.
+    def __init__(self, name, droplets, median, steps, paths = None, timings = None,
+                 refilterCount = 0, refilterTime = 0.0, status = "ok", frame = None):
+        if(not isinstance(droplets, DropletTable)):
+            droplets = DropletTable.fromDroplets(droplets)
+        if(not isinstance(steps, StepStore)):
+            steps = StepStore(steps, paths)
+        
         self.name = name
         self.median = median
         self.droplets = droplets
         self.steps = steps
-                
-        #make sure all images are in RGB format
-        for key in self.steps:
-            if(len(self.steps[key].shape) == 3):
-                self.steps[key] = cv.cvtColor(self.steps[key], cv.COLOR_BGR2RGB)
-            else:
-                self.steps[key] = cv.cvtColor(self.steps[key], cv.COLOR_GRAY2RGB)
+        self.paths = paths
+        self.timings = timings if timings is not None else {}
+        self.refilterCount = refilterCount
+        self.refilterTime = refilterTime
+        self.status = status
+        self.frame = frame
     
     def __repr__(self):
         return "<Image {}>".format(self.name)
@@ -78,15 +369,342 @@ class Image:
     def getSteps(self):
         return self.steps
     
+    def getPaths(self):
+        return self.paths
+    
+    def getTimings(self):
+        return self.timings
+    
+    def getRefilterCount(self):
+        return self.refilterCount
+    
+    def getRefilterTime(self):
+        return self.refilterTime
+    
+    def getStatus(self):
+        return self.status
+    
+    def getFrame(self):
+        return self.frame
+    
     def getImg(self):
         return self.steps["final"]
+
+class DropletLabels:
+    #the pixels covered by a list of (x, y, r) circles, drawn once for all of
+    #them. Entry k says that circle ids[k] covers the flattened pixel
+    #pixels[k]; a pixel under several circles has one entry per circle.
+    #Per-circle statistics are then single np.bincount passes over ids.
+    def __init__(self, shape, circles, filled = True):
+        self.shape = shape[:2]
+        self.count = len(circles)
+        height, width = self.shape
+        
+        allIds = [np.zeros(0, dtype = "int64")]
+        allPixels = [np.zeros(0, dtype = "int64")]
+        
+        #draw every circle of the same radius at once
+        for which, ys, xs, inside in stencilGroups(circles, self.shape, filled):
+            allIds.append(np.broadcast_to(which[:, None], ys.shape)[inside])
+            allPixels.append((ys * width + xs)[inside])
+        
+        self.ids = np.concatenate(allIds)
+        self.pixels = np.concatenate(allPixels)
+    
+    def __repr__(self):
+        return "<DropletLabels of {} circles>".format(self.count)
+    
+    def subset(self, keep):
+        #the labels of only the circles where keep (a boolean array) is True
+        newLabels = DropletLabels.__new__(DropletLabels)
+        newLabels.shape = self.shape
+        newLabels.count = int(np.sum(keep))
+        
+        entries = keep[self.ids]
+        newIds = np.cumsum(keep) - 1
+        newLabels.ids = newIds[self.ids[entries]]
+        newLabels.pixels = self.pixels[entries]
+        
+        return newLabels
+    
+    def values(self, img):
+        #the value of img under every entry
+        return img.ravel()[self.pixels]
+    
+    def sizes(self):
+        #number of pixels in each circle
+        return np.bincount(self.ids, minlength = self.count)
+    
+    def sum(self, values):
+        #sum of values (one per entry) in each circle
+        return np.bincount(self.ids, weights = values, minlength = self.count)
+    
+    def fraction(self, values):
+        #fraction of each circle's pixels where values is True
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            return self.sum(values) / self.sizes()
+    
+    def mean(self, img):
+        #mean of img in each circle, calculated the same way as cv.mean
+        sizes = self.sizes()
+        scale = np.zeros(self.count)
+        scale[sizes > 0] = 1. / sizes[sizes > 0]
+        return self.sum(self.values(img)) * scale
+    
+    def coverage(self):
+        #image of how many circles cover each pixel
+        return np.bincount(self.pixels, minlength = self.shape[0] * self.shape[1]).reshape(self.shape)
+
+class DropletGrid:
+    #a set of (x, y, r) droplets hashed into square cells of cellSize pixels,
+    #so the droplets near a circle are found without checking all of them.
+    #Iterating gives the droplets in the order they were added.
+    def __init__(self, droplets = (), cellSize = 32):
+        self.cellSize = max(int(cellSize), 1)
+        #cells: (column, row) -> set of keys of the droplets centred in it
+        self.cells = {}
+        #droplets: key -> droplet, in the order they were added
+        self.droplets = {}
+        #keysOf: (x, y, r) -> keys of droplets equal to it
+        self.keysOf = {}
+        self.nextKey = 0
+        #largest radius ever added; sets how far away an overlap can be
+        self.maxR = 0
+        
+        for drop in droplets:
+            self.add(drop)
+    
+    def __repr__(self):
+        return "<DropletGrid of {} droplets>".format(len(self))
+    
+    def __len__(self):
+        return len(self.droplets)
+    
+    def __iter__(self):
+        return iter(list(self.droplets.values()))
+    
+    def cellOf(self, x, y):
+        return (int(x) // self.cellSize, int(y) // self.cellSize)
+    
+    def add(self, drop):
+        x, y, r = drop
+        key = self.nextKey
+        self.nextKey += 1
+        
+        self.droplets[key] = drop
+        self.keysOf.setdefault(tuple(drop), []).append(key)
+        self.cells.setdefault(self.cellOf(x, y), set()).add(key)
+        self.maxR = max(self.maxR, r)
+    
+    def remove(self, drop):
+        #like list.remove, removes the first added droplet equal to drop
+        keys = self.keysOf.get(tuple(drop))
+        if(not keys):
+            raise ValueError("{} is not in the DropletGrid".format(drop))
+        
+        key = keys.pop(0)
+        if(len(keys) == 0):
+            del self.keysOf[tuple(drop)]
+        
+        x, y, r = self.droplets.pop(key)
+        cell = self.cellOf(x, y)
+        self.cells[cell].discard(key)
+        if(len(self.cells[cell]) == 0):
+            del self.cells[cell]
+    
+    def toList(self):
+        return list(self.droplets.values())
+    
+    def overlapping(self, main):
+        """Returns list of droplets that overlap with main, in the order they
+        were added."""
+        x1, y1, r1 = main
+        
+        #any overlapping droplet is centred within reach of main
+        reach = r1 + self.maxR
+        colMin, rowMin = self.cellOf(x1 - reach, y1 - reach)
+        colMax, rowMax = self.cellOf(x1 + reach, y1 + reach)
+        
+        #only check the cells in reach, unless that is more than all the cells
+        if((colMax - colMin + 1) * (rowMax - rowMin + 1) < len(self.cells)):
+            cells = [(col, row) for col in range(colMin, colMax + 1)
+                     for row in range(rowMin, rowMax + 1)]
+        else:
+            cells = list(self.cells.keys())
+        
+        keys = []
+        for cell in cells:
+            keys.extend(self.cells.get(cell, ()))
+        
+        ret = []
+        for key in sorted(keys):
+            x2, y2, r2 = self.droplets[key]
+            
+            #overlap if the centres are closer than the sum of the radii
+            if((r1 + r2) ** 2 > (x1 - x2) ** 2 + (y1 - y2) ** 2):
+                ret.append(self.droplets[key])
+        
+        return ret
+        
+class HoughDetector:
+    #finds droplets as circles with HoughCircles in the blurred image.
+    #Overlapping circles are usually parts of one bigger droplet that was
+    #missed, so analyzeImage re-searches regions where they overlap
+    #(refineOverlaps).
+    name = "hough"
+    refineOverlaps = True
+    
+    def __init__(self, minR = 5, maxR = 30, dp = 1, p1 = 15, p2 = 15):
+        self.minR = minR
+        self.maxR = maxR
+        self.dp = dp
+        self.p1 = p1
+        self.p2 = p2
+    
+    def __repr__(self):
+        return "<HoughDetector r {}-{}>".format(self.minR, self.maxR)
+    
+    def find(self, blurred, thresh):
+        """Returns a list of [x, y, r] circles in blurred, or None if there
+        are none. thresh is the threshold that separated the droplets from
+        the background (unused)."""
+        minDist = 2 * self.minR + 1
+        droplets = cv.HoughCircles(blurred, cv.HOUGH_GRADIENT,
+                                   dp = self.dp, minDist = minDist,
+                                   param1 = self.p1, param2 = self.p2,
+                                   minRadius = self.minR, maxRadius = self.maxR)
+
+        #adjust the droplets to be in the desired format
+        if(droplets is not None and len(droplets.shape) == 3):
+            droplets = droplets[0]
+
+        if(droplets is not None):
+            droplets = droplets.round(0).astype(int).tolist()
+        
+        return droplets
+
+class DistanceDetector:
+    #finds droplets as the peaks of the distance transform of the blurred
+    #image thresholded again: the centre of a droplet is the point furthest
+    #from the background, and that distance is its radius. Faster than
+    #HoughCircles, but only for droplets that are well separated or just
+    #touching, so overlaps are not re-searched. dp, p1 and p2 are unused.
+    name = "distance"
+    refineOverlaps = False
+    
+    def __init__(self, minR = 5, maxR = 30, dp = 1, p1 = 15, p2 = 15):
+        self.minR = minR
+        self.maxR = maxR
+    
+    def __repr__(self):
+        return "<DistanceDetector r {}-{}>".format(self.minR, self.maxR)
+    
+    def find(self, blurred, thresh):
+        """Returns a list of [x, y, r] circles in blurred, or None if there 
+        are none. thresh is the threshold that separated the droplets from
+        the background."""
+        #blurring spread the droplets out, so threshold them again
+        distance = cv.distanceTransform(threshold(blurred, thresh), cv.DIST_L2, 5)
+        
+        #peaks: the largest distance within minR of them
+        size = 2 * self.minR + 1
+        peaks = (distance == cv.dilate(distance, np.ones((size, size), dtype = "uint8")))
+        peaks &= (distance >= self.minR) & (distance <= self.maxR + 1)
+        
+        #a flat peak is several pixels; use the middle of each
+        count, peakLabels, stats, centres = cv.connectedComponentsWithStats(
+            peaks.astype("uint8"), connectivity = 8)
+        if(count <= 1):
+            return None
+        
+        centres = np.round(centres[1:]).astype(int)
+        #the distance transform is to the middle of the first background
+        #pixel, so the drawn radius is about half a pixel less
+        radii = distance[centres[:, 1], centres[:, 0]] - 0.5
+        
+        #biggest first, skipping peaks inside a droplet already found
+        order = np.argsort(-radii, kind = "stable")
+        grid = DropletGrid(cellSize = 2 * self.maxR)
+        droplets = []
+        for i in order:
+            x, y = centres[i]
+            r = int(round(radii[i]))
+            if(r < self.minR or len(grid.overlapping((x, y, 0))) > 0):
+                continue
             
+            drop = [int(x), int(y), min(r, self.maxR)]
+            grid.add(drop)
+            droplets.append(drop)
+        
+        return droplets if len(droplets) > 0 else None
+
+class PyramidDetector(HoughDetector):
+    #finds droplets coarse-to-fine: HoughCircles finds candidates in the
+    #blurred image shrunk by 2 ** levels (cv.pyrDown), where there are fewer
+    #pixels and radii to try. Then each candidate's centre and radius are
+    #refined at full resolution, only in a narrow ring around it (see
+    #refineCircles). Candidates without a clear edge there are dropped.
+    #Overlaps are re-searched like HoughDetector's.
+    name = "pyramid"
+    refineOverlaps = True
+    
+    def __init__(self, minR = 5, maxR = 30, dp = 1, p1 = 15, p2 = 15, levels = 1):
+        super().__init__(minR, maxR, dp, p1, p2)
+        self.levels = levels
+    
+    def __repr__(self):
+        return "<PyramidDetector r {}-{}, {} level(s)>".format(self.minR, self.maxR, self.levels)
+    
+    def find(self, blurred, thresh):
+        """Returns a list of [x, y, r] circles in blurred, or None if there
+        are none. thresh is unused."""
+        scale = 2 ** self.levels
+        
+        small = blurred
+        for level in range(self.levels):
+            small = cv.pyrDown(small)
+        
+        #the accumulator gets about scale times fewer votes per circle
+        candidates = cv.HoughCircles(small, cv.HOUGH_GRADIENT,
+                                     dp = self.dp, minDist = (2 * self.minR + 1) / scale,
+                                     param1 = self.p1, param2 = max(self.p2 / scale, 1),
+                                     minRadius = max(self.minR // scale, 1),
+                                     maxRadius = -(-self.maxR // scale))
+        if(candidates is None):
+            return None
+        
+        circles = candidates.reshape(-1, 3) * scale
+        refined, found = refineCircles(blurred, circles, scale + 1, self.minR, self.maxR)
+        refined = refined[found].round(0).astype(int).tolist()
+        
+        #two candidates can refine to the same droplet; keep the first
+        minDist = 2 * self.minR + 1
+        grid = DropletGrid(cellSize = 2 * self.maxR)
+        droplets = []
+        for drop in refined:
+            x, y, r = drop
+            near = grid.overlapping((x, y, minDist))
+            if(any((x - x2) ** 2 + (y - y2) ** 2 < minDist ** 2 for x2, y2, r2 in near)):
+                continue
+            
+            grid.add(drop)
+            droplets.append(drop)
+        
+        return droplets if len(droplets) > 0 else None
+
+#detectors analyzeImage can use, by name
+DETECTORS = {HoughDetector.name: HoughDetector,
+             DistanceDetector.name: DistanceDetector,
+             PyramidDetector.name: PyramidDetector}
+
 class ImageCollection:
     #represents a group of Images (usually from a folder.) Contains a list of 
     #Images and the index of the "current" image. 
     def __init__(self):
         self.allImgs = []
         self.index = 0
+        #RunReport of the analysis, if it was profiled
+        self.report = None
         
     def __repr__(self):
         return "<ImageCollection of length {}>".format(self.getLength())
@@ -126,106 +744,883 @@ class ImageCollection:
             return None
 
     def add(self, newImg):
+        newImg.getDroplets().setImageID(self.getLength())
         self.allImgs.append(newImg)
 
     def get(self, i):
         return self.allImgs[i]
     
+    def getDropletTable(self):
+        #one DropletTable with the droplets of every Image
+        return DropletTable.concatenate([img.getDroplets() for img in self.allImgs])
+    
     def getFinal(self, i):
         return self.allImgs[i][1].getFinal()
 
     def writeData(self, path):
-        fileName = "{}.csv".format(path)
-
-        #FORMAT: droplet ID, r, mean adjusted, img name, img ID, x, y, mean unadjusted
-        with open(fileName, mode = "w") as csvFile:
-            writer = csv.writer((csvFile), dialect = "excel")
-            
-            #header
-            csvHead = ["Droplet ID", "Radius", "Mean (adjusted)",
-                        "Image Name", "Image ID", "X pos.", "Y pos.", "Mean (unadjusted)"]
-            writer.writerow(csvHead)
-
+        with DropletWriter(path) as writer:
             #each image
             for i in range(self.getLength()):
-                img = self.get(i)
+                writer.write(self.get(i))
+        
+        #the timings of a profiled analysis go next to the data
+        if(self.report is not None):
+            self.report.write("{}-timings".format(path))
+
+class DropletWriter:
+    #writes the droplets of Images to a .csv file as they arrive, so the
+    #Images themselves don't have to be kept. The format is the same as
+    #ImageCollection.writeData. With append, rows are added to an existing
+    #file and the Image IDs carry on from the last one in it. The file must
+    #have the same columns (CSV_HEADER); a ValueError is raised otherwise.
+    def __init__(self, path, append = False):
+        self.fileName = "{}.csv".format(path)
+        self.nextID = 0
+        
+        appending = append and os.path.exists(self.fileName) and os.path.getsize(self.fileName) > 0
+        if(appending):
+            header = csvHeader(self.fileName)
+            if(header != CSV_HEADER):
+                raise ValueError("Can't append to {}: its columns ({}) are not {}".format(
+                    self.fileName, ", ".join(header), ", ".join(CSV_HEADER)))
+            self.nextID = nextImageID(self.fileName)
+        
+        self.csvFile = open(self.fileName, mode = "a" if appending else "w")
+        self.writer = csv.writer((self.csvFile), dialect = "excel")
+        
+        #header
+        if(not appending):
+            self.writer.writerow(CSV_HEADER)
+            self.csvFile.flush()
+    
+    def __repr__(self):
+        return "<DropletWriter to {}>".format(self.fileName)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+    
+    def write(self, img):
+        #write the rows of one Image and return the Image ID it was given
+        imgID = self.nextID
+        
+        self.writer.writerows(dropletRows(img, imgID))
+        self.csvFile.flush()
+        
+        self.nextID += 1
+        return imgID
+    
+    def close(self):
+        self.csvFile.close()
+
+class ResultCache:
+    #analysis results saved in a folder, so re-running on the same images
+    #only analyzes new or changed ones. Entries are keyed by the content of
+    #the image (or of its frame, for a frame of a TIFF stack) plus the 
+    #parameters it was analyzed with. Each is a .npz file with the Image's 
+    #name, median, re-filter count and time, status, frame, droplet table and
+    #output step images.
+    #An entry is only used if its step images are still in the output folder
+    #unchanged (or can be copied there from where they were first written).
+    #Files with the same content share an entry, so the name and frame of a
+    #result are those of the image it is looked up for.
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok = True)
+    
+    def __repr__(self):
+        return "<ResultCache in {}>".format(self.folder)
+    
+    def key(self, path, params, frame = None):
+        #hash of the image file's content (only the frame's, if it can be
+        #memory-mapped) and of the parameters
+        contentHash = hashlib.sha1()
+        try:
+            if(frame is None):
+                raise TiffError("not a frame")
+            contentHash.update(readPages(path)[frame].asarray())
+        except TiffError:
+            with open(path, mode = "rb") as imgFile:
+                for block in iter(lambda: imgFile.read(2 ** 20), b""):
+                    contentHash.update(block)
+        
+        if(frame is not None):
+            params = dict(params, frame = frame)
+        paramHash = hashlib.sha1(json.dumps(params, sort_keys = True).encode())
+        
+        return "{}-{}".format(contentHash.hexdigest(), paramHash.hexdigest()[:16])
+    
+    def entryPath(self, key):
+        return os.path.join(self.folder, "{}.npz".format(key))
+    
+    def get(self, key, outputPaths, name, frame = None):
+        """Returns the cached result (see imageResult) for key, as the
+        result of the Image name (and frame) with its steps at outputPaths
+        (name -> path), or None."""
+        try:
+            with np.load(self.entryPath(key), allow_pickle = False) as entry:
+                median = entry["median"].item()
+                refilterCount = entry["refilterCount"].item()
+                refilterTime = entry["refilterTime"].item()
+                status = entry["status"].item()
+                data = entry["droplets"]
+                oldPaths = dict(zip(entry["stepNames"].tolist(), entry["stepPaths"].tolist()))
+                stats = dict(zip(entry["stepNames"].tolist(), entry["stepStats"].tolist()))
+        except (OSError, KeyError, ValueError):
+            return None
+        
+        #entries from before the droplet table gained columns
+        if(data.dtype != DROPLET_DTYPE):
+            return None
+        
+        if(set(oldPaths.keys()) != set(outputPaths.keys())):
+            return None
+        
+        for stepName, path in outputPaths.items():
+            if(fileStat(path) != stats[stepName]):
+                #put the step in this output folder, if it is unchanged where
+                #it was first written
+                if(fileStat(oldPaths[stepName]) != stats[stepName]):
+                    return None
+                os.makedirs(os.path.dirname(path), exist_ok = True)
+                shutil.copy2(oldPaths[stepName], path)
+        
+        return {"name": name, "droplets": data, "median": median,
+                "paths": dict(outputPaths), "timings": {},
+                "refilterCount": refilterCount, "refilterTime": refilterTime,
+                "status": status, "frame": frame}
+    
+    def put(self, key, result):
+        """Saves a result (see imageResult). Its step images must already
+        be written."""
+        name, data, median, paths = (result["name"], result["droplets"],
+                                     result["median"], result["paths"])
+        stepNames = list(paths.keys())
+        
+        #write to a temporary file first so an entry is never half-written
+        tempPath = self.entryPath("{}-{}.tmp".format(key, os.getpid()))
+        with open(tempPath, mode = "wb") as entryFile:
+            np.savez(entryFile,
+                     name = np.array(name),
+                     median = np.array(median),
+                     refilterCount = np.array(result["refilterCount"]),
+                     refilterTime = np.array(result["refilterTime"]),
+                     status = np.array(result["status"]),
+                     frame = np.array(-1 if result["frame"] is None else result["frame"]),
+                     droplets = data,
+                     stepNames = np.array(stepNames),
+                     stepPaths = np.array([paths[stepName] for stepName in stepNames]),
+                     stepStats = np.array([fileStat(paths[stepName]) for stepName in stepNames],
+                                          dtype = "int64").reshape(-1, 2))
+        os.replace(tempPath, self.entryPath(key))
+
+class ImageWriteError(IOError):
+    #raised by ImageWriter when images could not be written
+    pass
+
+class ImageWriter:
+    #writes output images with cv.imwrite on a pool of background threads, so
+    #PNG compression doesn't hold up the analysis. At most maxPending images
+    #wait to be written; write() blocks until there is room. Errors from the
+    #threads are raised by the next write(), flush() or close().
+    #With threads = 0, images are written immediately in write().
+    def __init__(self, threads = 2, maxPending = 16, pngCompression = None):
+        self.threads = threads
+        #pngCompression: 0 (fastest, biggest files) to 9 (slowest, smallest)
+        self.params = []
+        if(pngCompression is not None):
+            self.params = [cv.IMWRITE_PNG_COMPRESSION, int(pngCompression)]
+        
+        self.executor = None
+        if(threads > 0):
+            self.executor = ThreadPoolExecutor(max_workers = threads)
+        self.slots = threading.BoundedSemaphore(maxPending)
+        self.pending = set()
+        self.errors = []
+        self.lock = threading.Lock()
+    
+    def __repr__(self):
+        return "<ImageWriter with {} threads, {} pending>".format(self.threads, len(self.pending))
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, excType, excValue, traceback):
+        #don't hide an exception that is already on its way out
+        if(excType is None):
+            self.close()
+        else:
+            self.shutdown()
+    
+    def writeNow(self, path, img, onWritten = None):
+        if(not cv.imwrite(path, img, self.params)):
+            raise ImageWriteError("Could not write {}".format(path))
+        if(onWritten is not None):
+            onWritten()
+    
+    def write(self, path, img, onWritten = None):
+        """Writes img to path. onWritten is called (from the writing thread)
+        once the file is complete. img must not be changed afterwards."""
+        self.raiseErrors()
+        
+        if(self.executor is None):
+            self.writeNow(path, img, onWritten)
+            return
+        
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self.writeNow, path, img, onWritten)
+        except BaseException:
+            self.slots.release()
+            raise
+        
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+    
+    def done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+            if(future.exception() is not None):
+                self.errors.append(future.exception())
+        self.slots.release()
+    
+    def raiseErrors(self):
+        with self.lock:
+            errors = self.errors
+            self.errors = []
+        
+        if(len(errors) == 1):
+            raise errors[0]
+        elif(len(errors) > 1):
+            raise ImageWriteError("{} images could not be written. First: {}".format(len(errors), errors[0]))
+    
+    def flush(self):
+        #wait until every image has been written
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+        
+        self.raiseErrors()
+    
+    def shutdown(self):
+        if(self.executor is not None):
+            self.executor.shutdown(wait = True)
+    
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.shutdown()
+
+def readImage(path, frame = None):
+    #reads an 8-bit or 16-bit grayscale image like analyzeImage does, or a
+    #frame of a TIFF stack
+    if(frame is not None):
+        return readFrame(path, frame)
+    
+    img = cv.imread(path, cv.IMREAD_ANYDEPTH)
+    if(img is None):
+        raise IOError("Could not read {}".format(path))
+    
+    return img
+
+class ImageReader:
+    #reads (decodes) a list of images on background threads ahead of when
+    #they are asked for, so disk reads and decoding overlap the analysis.
+    #get() returns the (path, image) pairs in order. At most readAhead
+    #images are read ahead; with readAhead = 0, get() reads in line.
+    #read(path) reads one image (by default, readImage).
+    #It keeps count of the time spent reading (readSeconds, summed over the
+    #threads), waiting in get() for an image (waitSeconds), and between
+    #get() calls, i.e. analyzing (computeSeconds).
+    def __init__(self, paths, readAhead = 2, threads = 1, read = None):
+        self.paths = list(paths)
+        self.readAhead = readAhead
+        self.read = readImage if read is None else read
+
+        self.executor = None
+        if(readAhead > 0):
+            self.executor = ThreadPoolExecutor(max_workers = max(threads, 1))
+        #futures of the images being read ahead, in order
+        self.queue = []
+        self.nextIndex = 0
+
+        self.readSeconds = 0.0
+        self.waitSeconds = 0.0
+        self.computeSeconds = 0.0
+        self.lastGet = None
+        self.lock = threading.Lock()
 
-                droplets = img.getDroplets()
+    def __repr__(self):
+        return "<ImageReader of {} images, {} read ahead>".format(len(self.paths), len(self.queue))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def readTimed(self, path):
+        start = time.perf_counter()
+        img = self.read(path)
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.readSeconds += elapsed
+
+        return img
+
+    def fill(self):
+        #start reading images until readAhead are on their way
+        while(len(self.queue) < self.readAhead and self.nextIndex < len(self.paths)):
+            path = self.paths[self.nextIndex]
+            self.queue.append((path, self.executor.submit(self.readTimed, path)))
+            self.nextIndex += 1
+
+    def get(self):
+        """Returns the next (path, image) pair. Raises StopIteration once all
+        of them have been returned."""
+        start = time.perf_counter()
+        if(self.lastGet is not None):
+            self.computeSeconds += start - self.lastGet
+
+        if(self.executor is None):
+            if(self.nextIndex >= len(self.paths)):
+                raise StopIteration
+            path = self.paths[self.nextIndex]
+            self.nextIndex += 1
+            img = self.readTimed(path)
+        else:
+            self.fill()
+            if(len(self.queue) == 0):
+                raise StopIteration
+            path, future = self.queue.pop(0)
+            img = future.result()
+            #start on the next image before this one is analyzed
+            self.fill()
+
+        self.lastGet = time.perf_counter()
+        self.waitSeconds += self.lastGet - start
+
+        return path, img
+
+    def __iter__(self):
+        while(True):
+            try:
+                yield self.get()
+            except StopIteration:
+                return
+
+    def stats(self):
+        return {"images": self.nextIndex, "readSeconds": self.readSeconds,
+                "waitSeconds": self.waitSeconds, "computeSeconds": self.computeSeconds}
+
+    def close(self):
+        if(self.executor is not None):
+            for path, future in self.queue:
+                future.cancel()
+            self.queue = []
+            self.executor.shutdown(wait = True)
+
+class FolderWatcher:
+    #finds the images with the imgType in a folder as they are written to
+    #it, e.g. during an experiment. A file is only found once its size and
+    #modification time have stayed the same for settle seconds (and at
+    #least one poll), so files that are still being written are skipped
+    #until they are complete. A found file is found again once it has
+    #changed and settled again (e.g. frames were added to a TIFF stack).
+    #A file given back with retry (e.g. because it could not be read after
+    #all) is likewise found again once it has changed and settled again.
+    def __init__(self, folder, imgType, settle = 1.0):
+        self.folder = folder
+        self.imgType = imgType
+        self.settle = settle
+        #path -> fileStat of the files already found
+        self.found = {}
+        #path -> (fileStat, time it was first seen with it) of files not
+        #found yet. The time is None for files given back with retry, which
+        #wait for their fileStat to change.
+        self.pending = {}
+        #time a file last appeared or changed
+        self.lastChange = time.perf_counter()
+    
+    def __repr__(self):
+        return "<FolderWatcher of .{} images in {}>".format(self.imgType, self.folder)
+    
+    def poll(self):
+        """Returns the paths of the files that have become complete, or
+        complete again after changing, since the last poll, in glob order."""
+        now = time.perf_counter()
+        ready = []
+        
+        for path in glob(os.path.join(self.folder, "*.{}".format(self.imgType))):
+            stat = fileStat(path)
+            if(stat is None or stat[0] == 0):
+                #removed, or nothing written yet
+                continue
+            
+            if(path in self.found):
+                if(self.found[path] == stat):
+                    continue
+                #changed since it was found; wait for it to settle again
+                del self.found[path]
+            
+            last = self.pending.get(path)
+            if(last is None or last[0] != stat):
+                self.pending[path] = (stat, now)
+                self.lastChange = now
+            elif(last[1] is not None and now - last[1] >= self.settle):
+                del self.pending[path]
+                self.found[path] = stat
+                ready.append(path)
+        
+        return ready
+    
+    def retry(self, path):
+        """Gives back a found file, to be found again once its size or 
+        modification time changes and it has settled again."""
+        if(path in self.found):
+            self.pending[path] = (self.found.pop(path), None)
+    
+    def idleSeconds(self):
+        """Returns the seconds since a file last appeared or changed."""
+        return time.perf_counter() - self.lastChange
+
+class StageTimer:
+    #records the wall time and the peak bytes allocated (as traced by
+    #tracemalloc, above what was allocated when the stage began) of named
+    #stages. A stage either runs from begin(name) to the next begin() or 
+    #end(), or is used as "with timer.stage(name):". Stages can be nested,
+    #also across StageTimers; a stage's peak includes the stages inside it.
+    #Stages that run more than once add up their times.
+    #A StageTimer made with enabled = False records nothing.
+    #If tracemalloc isn't tracing yet, the StageTimer starts it, and stop()
+    #stops it again once timing is done, so later code doesn't pay for it.
+    openStages = []
+    
+    def __init__(self, enabled = True):
+        self.enabled = enabled
+        self.times = OrderedDict()
+        self.peaks = OrderedDict()
+        self.current = None
+        
+        #whether this StageTimer started tracemalloc
+        self.startedTracing = enabled and not tracemalloc.is_tracing()
+        if(self.startedTracing):
+            tracemalloc.start()
+    
+    def __repr__(self):
+        return "<StageTimer of {}>".format(", ".join(self.times.keys()))
+    
+    def begin(self, name):
+        if(self.enabled):
+            self.end()
+            self.current = self.open(name)
+    
+    def end(self):
+        if(self.current is not None):
+            self.close(self.current)
+            self.current = None
+    
+    @contextmanager
+    def stage(self, name):
+        if(not self.enabled):
+            yield
+            return
+        
+        frame = self.open(name)
+        try:
+            yield
+        finally:
+            self.close(frame)
+    
+    def open(self, name):
+        allocated, peak = tracemalloc.get_traced_memory()
+        
+        #the enclosing stage keeps its peak so far; this one starts afresh
+        if(len(StageTimer.openStages) > 0):
+            outer = StageTimer.openStages[-1]
+            outer["peak"] = max(outer["peak"], peak)
+        tracemalloc.reset_peak()
+        
+        frame = {"name": name, "start": time.perf_counter(),
+                 "allocated": allocated, "peak": allocated}
+        StageTimer.openStages.append(frame)
+        
+        return frame
+    
+    def close(self, frame):
+        elapsed = time.perf_counter() - frame["start"]
+        allocated, peak = tracemalloc.get_traced_memory()
+        frame["peak"] = max(frame["peak"], peak)
+        
+        if(frame in StageTimer.openStages):
+            StageTimer.openStages.remove(frame)
+        if(len(StageTimer.openStages) > 0):
+            outer = StageTimer.openStages[-1]
+            outer["peak"] = max(outer["peak"], frame["peak"])
+        tracemalloc.reset_peak()
+        
+        name = frame["name"]
+        self.times[name] = self.times.get(name, 0) + elapsed
+        self.peaks[name] = max(self.peaks.get(name, 0), frame["peak"] - frame["allocated"])
+    
+    def stop(self):
+        #end the current stage, and stop tracemalloc if this started it
+        self.end()
+        if(self.startedTracing):
+            self.startedTracing = False
+            tracemalloc.stop()
+    
+    def getTimings(self):
+        #stage name -> {"seconds": wall time, "peakBytes": peak allocated bytes}
+        self.end()
+        return OrderedDict((name, {"seconds": self.times[name], "peakBytes": self.peaks[name]})
+                           for name in self.times)
+
+class RunReport:
+    #the stage timings of a profiled run: each Image's own, their sums, and
+    #the stages of the run itself (timer). Written as a .csv file with one
+    #row per image and stage, and a .json file with the totals, what the
+    #BufferArena of the writing thread reused (with several workers, each
+    #worker has its own) and how long the run waited for images to be read.
+    def __init__(self):
+        self.timer = StageTimer()
+        self.imageTimings = []
+        #ImageReader.stats of the run, if it read ahead in this process
+        self.reads = None
+    
+    def __repr__(self):
+        return "<RunReport of {} images>".format(len(self.imageTimings))
+    
+    def add(self, image):
+        self.imageTimings.append((image.getName(), image.getTimings()))
+    
+    def totals(self):
+        #stage name -> summed seconds and largest peak over all Images
+        totals = OrderedDict()
+        
+        for name, timings in self.imageTimings:
+            for stage, timing in timings.items():
+                total = totals.setdefault(stage, {"seconds": 0, "peakBytes": 0})
+                total["seconds"] += timing["seconds"]
+                total["peakBytes"] = max(total["peakBytes"], timing["peakBytes"])
+        
+        return totals
+    
+    def write(self, path):
+        with open("{}.csv".format(path), mode = "w") as csvFile:
+            writer = csv.writer((csvFile), dialect = "excel")
+            writer.writerow(["Image Name", "Stage", "Seconds", "Peak bytes"])
+            
+            for name, timings in self.imageTimings:
+                for stage, timing in timings.items():
+                    writer.writerow([name, stage, timing["seconds"], timing["peakBytes"]])
+            
+            for stage, timing in self.totals().items():
+                writer.writerow(["(all images)", stage, timing["seconds"], timing["peakBytes"]])
+            
+            for stage, timing in self.timer.getTimings().items():
+                writer.writerow(["(run)", stage, timing["seconds"], timing["peakBytes"]])
+        
+        with open("{}.json".format(path), mode = "w") as jsonFile:
+            json.dump({"images": len(self.imageTimings),
+                       "imageStages": self.totals(),
+                       "runStages": self.timer.getTimings(),
+                       "bufferArena": threadArena().stats(),
+                       "reads": self.reads},
+                      jsonFile, indent = 4)
 
-                for j in range(len(droplets)):
-                    imgName = img.getName()
-                    imgID = i
+#################### HELPER FUNCTIONS ####################
 
-                    dropID = "I{imgID}-D{dropNum}".format(imgID = imgID, dropNum = j)
+#FORMAT: droplet ID, r, mean adjusted, img name, img ID, x, y, mean unadjusted
+CSV_HEADER = ["Droplet ID", "Radius", "Mean (adjusted)",
+              "Image Name", "Image ID", "X pos.", "Y pos.", "Mean (unadjusted)",
+              "Image Status", "Frame", "Disc Mean", "Disc Median", "Disc Std",
+              "Integrated Intensity", "Max", "Saturated Pixels"]
+
+def dropletRows(img, imgID):
+    """Returns the .csv rows for every droplet in an Image, taking whole 
+    columns from its DropletTable. A rejected Image gets one row with only
+    its name, ID, status and frame."""
+    data = img.getDroplets().data
+    median = img.getMedian()
+    status = img.getStatus()
+    frame = "" if img.getFrame() is None else img.getFrame()
+    
+    if(status != "ok"):
+        return [["", "", "", img.getName(), imgID, "", "", "", status, frame,
+                 "", "", "", "", "", ""]]
+    
+    dropIDs = ["I{imgID}-D{dropNum}".format(imgID = imgID, dropNum = j)
+               for j in range(len(data))]
+    
+    meansU = [round(mean, 2) for mean in data["mean"].tolist()]
+    meansA = [meanU - median for meanU in meansU]
+    
+    return zip(dropIDs, data["r"].tolist(), meansA,
+               repeat(img.getName()), repeat(imgID),
+               data["x"].tolist(), data["y"].tolist(), meansU, repeat(status),
+               repeat(frame), *[data[name].round(2).tolist() for name in STATS_COLUMNS])
+
+def csvHeader(fileName):
+    """Returns the first row (the column names) of a .csv file."""
+    with open(fileName, mode = "r") as csvFile:
+        return next(csv.reader(csvFile, dialect = "excel"), [])
+
+def nextImageID(fileName):
+    """Returns the Image ID after the largest one in a droplet .csv file."""
+    lastID = -1
+    
+    with open(fileName, mode = "r") as csvFile:
+        reader = csv.reader(csvFile, dialect = "excel")
+        next(reader, None)
+        
+        for row in reader:
+            if(len(row) > 4 and row[4] != ""):
+                lastID = max(lastID, int(row[4]))
+    
+    return lastID + 1
 
-                    r = droplets[j].getRstr()
-                    x = droplets[j].getXstr()
-                    y = droplets[j].getYstr()
+def csvImageNames(fileName):
+    """Returns the set of the Image Names in a droplet .csv file."""
+    with open(fileName, mode = "r") as csvFile:
+        reader = csv.reader(csvFile, dialect = "excel")
+        next(reader, None)
+        
+        return set(row[3] for row in reader if len(row) > 3)
 
-                    meanU = round(droplets[j].getMean(), 2)
-                    meanA = meanU - img.getMedian()
+def show(img):
+    #for debugging; matplotlib is only imported here, so that analysis
+    #(e.g. from dropletAnalysisCLI) doesn't need it
+    from matplotlib import pyplot as plt
+    plt.imshow(img, cmap = "gray")
 
-                    writer.writerow([dropID, r, meanA,
-                                    imgName, imgID, x, y, meanU])
+#names of the step images written by analyzeImage in debug mode
+DEBUG_STEPS = ["original", "mask", "blurred", "overlapping", "markers",
+               "overlapResult", "allDroplets", "final"]
+
+def fileStat(path):
+    """Returns [size, modification time in ns] of a file, or None."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def imageName(path, frame = None):
+    """Returns the name analyzeImage gives to the image at path, or to its
+    frame of a TIFF stack."""
+    imgName = os.path.split(path)[1]
+    #reformat imgName so there are no periods
+    imgName = imgName[:-4].replace("-", "_").replace(".", "-")
+    
+    if(frame is not None):
+        imgName += "_f{:04d}".format(frame)
+    return imgName
+
+def imageFrames(path):
+    """Returns the frames of a TIFF stack at path, or [None] for a single 
+    image (a TIFF file with one page is a single image)."""
+    count = frameCount(path)
+    return list(range(count)) if count > 1 else [None]
+
+def folderImages(inputFolder, imgType):
+    """Finds the images with the imgType (e.g. png, tif) in the inputFolder.
+    TIFF files whose frames can't be listed are reported and left out.
+    
+    RETURNS:
+        files: list of the paths of the image files, in glob order
+        images: list of (path, frame) of every image to analyze; frame is
+            None unless the file is a TIFF stack (see imageFrames)
+    """
+    files = glob(os.path.join(inputFolder, "*.{}".format(imgType)))
+    
+    if(imgType.lower() in ("tif", "tiff")):
+        readable = []
+        images = []
+        for fn in files:
+            try:
+                frames = imageFrames(fn)
+            except (TiffError, OSError, cv.error) as e:
+                print("\tSkipped {}: {}".format(os.path.split(fn)[1], e))
+                continue
+            
+            readable.append(fn)
+            images.extend((fn, frame) for frame in frames)
+        files = readable
+    else:
+        images = [(fn, None) for fn in files]
+    
+    return files, images
 
-#################### HELPER FUNCTIONS ####################
+def outputPaths(outputFolder, imgName, stepNames, debug):
+    """Returns a dict of the paths analyzeImage writes each step image to."""
+    if(debug):
+        subFolder = os.path.join(outputFolder, imgName)
+        return {name: os.path.join(subFolder, "{}-{}.png".format(i, name))
+                for i, name in enumerate(stepNames)}
+    else:
+        return {"final": os.path.join(outputFolder, "{}.png".format(imgName))}
+
+@lru_cache(maxsize = None)
+def circleOffsets(r, filled = True):
+    """Returns the (dy, dx) offsets, from the centre, of the pixels cv.circle 
+    draws for a circle of radius r (the disc stencil). filled = False gives
+    the 1 pixel outline (the ring stencil). Each stencil is made once and
+    then kept, so the arrays must not be changed."""
+    size = 2 * r + 3
+    canvas = np.zeros((size, size), dtype = "uint8")
+    cv.circle(canvas, (r + 1, r + 1), r, 1, -1 if filled else 1)
+    
+    dy, dx = np.nonzero(canvas)
+    dy -= r + 1
+    dx -= r + 1
+    dy.flags.writeable = False
+    dx.flags.writeable = False
+    
+    return dy, dx
 
-def show(img):
-    #for debugging
-    plt.imshow(img, cmap = "gray")
+def stencilGroups(circles, shape, filled = True):
+    """Places the stencils (see circleOffsets) of a list of (x, y, r) 
+    circles in a frame of shape, all circles of the same radius at once.
+    Masks, statistics and drawing all go through here.
+    
+    YIELDS, for each radius:
+        which: indices (in circles) of the circles of that radius
+        ys, xs: 2-D arrays of the coordinates of their pixels, one row per
+            circle, clipped to the frame so they can always be indexed
+        inside: 2-D boolean array, whether each pixel is really in the frame
+            (the clipped ones aren't)
+    """
+    circles = np.asarray(circles, dtype = "int64").reshape(-1, 3)
+    height, width = shape[:2]
+    
+    for r in np.unique(circles[:, 2]):
+        which = np.flatnonzero(circles[:, 2] == r)
+        dy, dx = circleOffsets(int(r), filled)
+        
+        ys = circles[which, 1][:, None] + dy
+        xs = circles[which, 0][:, None] + dx
+        inside = (ys >= 0) & (ys < height) & (xs >= 0) & (xs < width)
+        
+        yield which, ys.clip(0, height - 1), xs.clip(0, width - 1), inside
+
+def drawCircles(img, circles, color, filled = False):
+    """Draws a list of (x, y, r) circles on img (in place) like cv.circle 
+    with thickness 1 (or -1, if filled) would, from their stencils. 
+    Returns img."""
+    for which, ys, xs, inside in stencilGroups(circles, img.shape, filled):
+        img[ys[inside], xs[inside]] = color
+    
+    return img
 
-def threshold(img, thresh):
-    #shortcut for thresholding an image
-    ret, threshed = cv.threshold(img, thresh, 255, cv.THRESH_BINARY)
+def dropletStats(img, circles, saturation = None):
+    """Intensity statistics of img in the filled disc of each droplet, all
+    droplets of the same radius at once.
+    
+    PARAMETERS:
+        img: the frame as read (8-bit or 16-bit)
+        circles: list of (x, y, r) droplets
+        saturation: value at which the camera saturates (by default the
+            largest value of img's type, as in screenFrame)
+    
+    RETURNS:
+        dict of STATS_COLUMNS -> array with a value for each droplet: the 
+        mean, median, (population) standard deviation, sum ("integrated")
+        and maximum of the disc, and how many of its pixels are saturated
+    
+    METHOD:
+        The droplets of each radius are stacked into one 2-D array of the
+        pixels under the disc stencil of that radius (see stencilGroups),
+        one row per droplet. Pixels of the stencil outside the frame are
+        masked out, so droplets at the border only count what is inside.
+    """
+    stats = {name: np.zeros(len(circles)) for name in STATS_COLUMNS}
+    
+    if(saturation is None):
+        saturation = np.iinfo(img.dtype).max
+    
+    for which, ys, xs, inside in stencilGroups(circles, img.shape, True):
+        values = img[ys, xs].astype("float64")
+        counts = np.maximum(inside.sum(axis = 1), 1)
+        
+        integrated = np.where(inside, values, 0).sum(axis = 1)
+        mean = integrated / counts
+        deviations = np.where(inside, values - mean[:, None], 0)
+        
+        #outside pixels sort last, so the middle of each row is its median
+        ordered = np.sort(np.where(inside, values, np.inf), axis = 1)
+        rows = np.arange(len(which))
+        median = (ordered[rows, (counts - 1) // 2] + ordered[rows, counts // 2]) / 2
+        
+        stats["discMean"][which] = mean
+        stats["discMedian"][which] = median
+        stats["discStd"][which] = np.sqrt((deviations ** 2).sum(axis = 1) / counts)
+        stats["integrated"][which] = integrated
+        stats["max"][which] = np.where(inside, values, 0).max(axis = 1)
+        stats["saturated"][which] = (inside & (values >= saturation)).sum(axis = 1)
+    
+    return stats
+
+def processPool(workers):
+    """Returns a ProcessPoolExecutor with workers processes. It is only
+    imported here, as importing it imports multiprocessing, which is only
+    needed with more than one worker."""
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(max_workers = workers)
+
+def threshold(img, thresh, dst = None):
+    #shortcut for thresholding an image (into dst, if given)
+    ret, threshed = cv.threshold(img, thresh, 255, cv.THRESH_BINARY, dst = dst)
     return threshed
 
 def black(refImg):
     #shortcut for a black uint8 image
     return np.zeros(refImg.shape, dtype = "uint8")
 
-def normalize16(image):
-    """Convert a 16-bit image into an 8-bit image."""
+def normalize16(image, levels = None, dst = None):
+    """Convert a 16-bit image into an 8-bit image (dst, if given). levels is
+    the (low, high) pair of values to scale to 0 and 255; by default, the 
+    image's minimum and maximum."""
     if(image.dtype != "uint16"):
         raise TypeError("Image is not a 16-bit image.")
-        
-    normalized = np.zeros(image.shape, dtype = "uint8")
-    cv.normalize(image, normalized, 0, 255, cv.NORM_MINMAX, dtype = 8)
-    return normalized
-
-def medianMasked(img, mask):
-    if(len(img.shape) != 2):
-        raise Exception("img is not 2-dimensional")
-    elif(len(mask.shape) != 2):
-        raise Exception("mask is not 2-dimensional")
     
-    if(img.dtype == "uint8"):
-        hist = cv.calcHist([img], [0], mask, [256], (0, 256))
-    elif(img.dtype == "uint16"):
-        hist = cv.calcHist([img], [0], mask, [2 ** 16], (0, 2 ** 16))
-    else:
-        raise TypeError("img is not of type uint8 or uint16")
+    if(levels is not None):
+        low, high = levels
+        scale = 255 / (high - low) if high > low else 0
+        return cv.convertScaleAbs(image, dst, alpha = scale, beta = -low * scale)
+    
+    normalized = np.zeros(image.shape, dtype = "uint8") if dst is None else dst
+    return cv.normalize(image, normalized, 0, 255, cv.NORM_MINMAX, dtype = 8)
 
-    median = medianHist(hist)
+def medianMasked(img, mask, bits = None):
+    """Returns the median (most common value, ignoring 0) of img under mask.
+    bits is the number of histogram bits to use; e.g. bits = 12 bins a
+    16-bit image 16 values per bin. By default every value has a bin."""
+    hist = Histogram.fromImage(img, mask, bits)
 
-    return median
+    return hist.value(hist.mode())
 
 def medianHist(hist):
     """Returns the median index of a histogram."""
-    max = hist[1][0]
-    maxIndex = 1
-    for i in range(1, len(hist)):
-        if(hist[i][0] > max):
-            max = hist[i][0]
-            maxIndex = i
-    
-    return maxIndex
+    return Histogram(np.ravel(hist), 8).mode()
 
-def getThresh(img, blur = True):
+def getThresh(img, blur = True, hist = None, dst = None):
     """Returns the threshold value for an image.
     
     PARAMETERS:
         img: 8-bit grayscale image, as a np array
         blur: whether to blur the image before calculating the histogram
+        hist: Histogram of img (after blurring) to use instead of 
+            calculating it
+        dst: image to blur img into, instead of a new one
     
     RETURNS:
         The threshold value to use.
@@ -235,7 +1630,7 @@ def getThresh(img, blur = True):
         Second, generate a histogram from the image
         Next, travel through the histogram starting a little after the median
         Then, the function searches for when the histogram increases again
-        If there is no increase, it returns the index of (median + 2)
+        If there is no increase, it returns the index of (median + 4)
         
         This method is based off the assumption that the histogram will have
         at least two peaks. The largest peak is of dark background pixels.
@@ -243,71 +1638,203 @@ def getThresh(img, blur = True):
         second peak starts can thus be used to separate droplets from their
         background.
     """
+    if(hist is None):
+        #blur
+        if(blur):
+            blurred = cv.GaussianBlur(img, (5, 5), 1, dst = dst)
+        else:
+            blurred = img
+
+        hist = Histogram.fromImage(blurred)
+    
+    #the valley after the median + 4
+    return hist.threshold(4)
+
+def screenFrame(grayOrig, gray, step = 4, saturation = None,
+                saturatedFraction = 0.05, brightMedian = 200,
+                minContrast = 6, minSharpness = 0.12):
+    """Cheaply decides whether a frame is worth analyzing, from every step-th
+    pixel in each direction.
+    
+    PARAMETERS:
+        grayOrig: the frame as read (8-bit or 16-bit)
+        gray: the frame as 8-bit (see analyzeImage)
+        step: subsampling step
+        saturation: value at which the camera saturates (by default the
+            largest value of grayOrig's type)
+        saturatedFraction: a frame with more saturated pixels is "saturated"
+        brightMedian: a frame whose 8-bit median is at least this is 
+            "over-bright"
+        minContrast: a frame whose brightest pixels are less than this many
+            noise standard deviations above the median is "empty"
+        minSharpness: a frame whose steepest edges change by less than this
+            fraction of the contrast per pixel is "out of focus"
+    
+    RETURNS:
+        "ok", or why the frame should be rejected: "saturated", 
+        "over-bright", "empty" or "out of focus"
+    
+    METHOD:
+        The noise is estimated from the differences between neighbouring
+        subsampled pixels, which are far enough apart that droplets barely
+        affect it. The brightest pixels and steepest edges are the 4th
+        largest values, so a few hot pixels don't count.
+    """
+    sub = grayOrig[::step, ::step]
+    
+    if(saturation is None):
+        saturation = np.iinfo(sub.dtype).max
+    if(np.count_nonzero(sub >= saturation) > saturatedFraction * sub.size):
+        return "saturated"
+    
+    #gray is mostly background, so its median is the background's
+    subHist = Histogram.fromImage(np.ascontiguousarray(gray[::step, ::step]))
+    if(np.searchsorted(np.cumsum(subHist.counts), subHist.total() / 2) >= brightMedian):
+        return "over-bright"
+    
+    sub = sub.astype("float32")
+    values = sub.ravel()
+    median = float(np.median(values))
+    brightest = float(np.partition(values, values.size - 4)[values.size - 4])
+    
+    steps = np.abs(sub[:, 1:] - sub[:, :-1])
+    noise = max(float(np.median(steps)) / (0.6745 * np.sqrt(2)), 1.0)
+    
+    contrast = brightest - median
+    if(contrast < minContrast * noise):
+        return "empty"
+    
+    #steepness of edges, from a lightly smoothed gradient
+    smoothed = cv.GaussianBlur(sub, (3, 3), 0)
+    gradX = cv.Sobel(smoothed, cv.CV_32F, 1, 0, scale = 1 / 8)
+    gradY = cv.Sobel(smoothed, cv.CV_32F, 0, 1, scale = 1 / 8)
+    gradient = cv.magnitude(gradX, gradY).ravel()
+    steepest = float(np.partition(gradient, gradient.size - 4)[gradient.size - 4])
+    
+    if(steepest < minSharpness * contrast):
+        return "out of focus"
+    
+    return "ok"
+
+def tooDark(img, circle):
+    """Determines if a circle in a thresholded image is over 20% black.
+    This is used to determine if a droplet is a false positive.
+    """
+    #only look at the pixels under the circle
+    labels = DropletLabels(img.shape, [circle])
+    
+    #calculate percentage of the circle that is black
+    percentage = labels.fraction(labels.values(img) == 0)[0]
+        
+    return (percentage > 0.2) #Cut-off value is 20%; 10% is too low
+
+def roiWindow(roi, origin, frameShape, margin, dp = 1):
+    """Places roi, whose top left corner is at origin in a frame of 
+    frameShape, in a black window that extends margin pixels around it 
+    (cut off at the edges of the frame).
+    
+    RETURNS:
+        window: the black window with roi copied into it
+        (wx, wy): frame coordinates of the top left corner of window
+    
+    (wx, wy) are whole multiples of dp where possible (e.g. of 3 for dp = 1.5),
+    so HoughCircles on the window uses the same accumulator cells as it would
+    on the frame.
+    """
+    x0, y0 = origin
+    height, width = roi.shape[:2]
     
-    #blur
-    if(blur):
-        blurred = cv.GaussianBlur(img, (5, 5), 1)
-    else:
-        blurred = img
-
-    #get median
-    hist = cv.calcHist(images = [blurred], 
-                        channels = [0], 
-                        mask = None, 
-                        histSize = [256], 
-                        ranges = (0, 256))
-    median = medianHist(hist)
-    
-    #initialize values to traverse through the histogram
-    #starting from the median + 4
-
-    #i: index
-    i = median + 4
-    #retValue: threshold value to return
-    retValue = median + 4
-    #oldNum: the value of the histogram at the previous index
-    oldNum = hist[i][0]
-    
-    i += 1
-    
-    #go through the histogram, finding when the frequency of a value goes up, not down
-    while(i < 256):
-        if(hist[i][0] > oldNum):
-            retValue = i - 1
-            break
-        else:
-            oldNum = hist[i][0]
-            i += 1
+    #imported here, like processPool, to keep importing this module fast
+    from fractions import Fraction
+    step = Fraction(dp).limit_denominator(1000).numerator
+    
+    wx = max(x0 - margin, 0) // step * step
+    wy = max(y0 - margin, 0) // step * step
+    wx1 = min(x0 + width + margin, frameShape[1])
+    wy1 = min(y0 + height + margin, frameShape[0])
     
-    return retValue
+    window = np.zeros((wy1 - wy, wx1 - wx), dtype = roi.dtype)
+    window[y0 - wy:y0 - wy + height, x0 - wx:x0 - wx + width] = roi
+    
+    return window, (wx, wy)
 
-def tooDark(img, circle):
-    """Determines if a circle in a thresholded image is over 20% black.
-    This is used to determine if a droplet is a false positive.
+def refineCircles(img, circles, band, minR, maxR, rays = 32):
+    """Refines rough (x, y, r) circles of bright droplets in img. 
+    
+    Along each of rays rays from a circle's centre, the edge is where the 
+    brightness drops the most within band pixels of r. A circle is fitted to
+    those edge points by least squares (ignoring rays with a weak edge, 
+    e.g. into a touching droplet). All circles are refined at once.
+    
+    RETURNS:
+        refined: float array of (x, y, r) rows
+        found: boolean array, False where a circle has too few edges, or 
+            the fitted circle is outside minR...maxR or moved more than band
     """
-    #unpack the circle
-    x, y, r = circle
+    circles = np.asarray(circles, dtype = "float32").reshape(-1, 3)
+    count = len(circles)
     
-    r = int(r)
-    x = int(x)
-    y = int(y)
+    #sample img (bilinear) along the rays, only within band of r
+    angles = np.linspace(0, 2 * np.pi, rays, endpoint = False, dtype = "float32")
+    cos, sin = np.cos(angles), np.sin(angles)
+    firstStep = np.maximum(np.floor(circles[:, 2]) - band - 1, 0)
+    steps = firstStep[:, None] + np.arange(2 * band + 4, dtype = "float32")[None, :]
     
-    #make mask
-    mask = black(img)
-    mask = cv.circle(mask, (x, y), r, 1, -1)
+    mapX = circles[:, 0, None, None] + cos[None, :, None] * steps[:, None, :]
+    mapY = circles[:, 1, None, None] + sin[None, :, None] * steps[:, None, :]
     
-    #find pixels where the droplet should be, but the img has nothing
-    different = ((mask == 1) & (img == 0))
-
-    #calculate percentage of the circle that is black    
-    white = np.sum(different)
-    total = np.sum(mask)
-    percentage = white / total
-        
-    return (percentage > 0.2) #Cut-off value is 20%; 10% is too low
+    #one row per circle; remap takes at most 32767 rows at a time
+    width = rays * steps.shape[1]
+    profiles = np.empty(mapX.shape, dtype = "float32")
+    for start in range(0, count, 32767):
+        rows = slice(start, start + 32767)
+        profiles[rows] = cv.remap(img, mapX[rows].reshape(-1, width), mapY[rows].reshape(-1, width),
+                                  cv.INTER_LINEAR,
+                                  borderMode = cv.BORDER_REPLICATE).reshape(-1, rays, steps.shape[1])
+    
+    #drop in brightness between each step and the next, within band of r
+    drops = profiles[:, :, :-1] - profiles[:, :, 1:]
+    edgeR = steps[:, :-1] + 0.5
+    near = np.abs(edgeR - circles[:, 2, None]) <= band
+    drops = np.where(near[:, None, :], drops, -np.inf)
+    
+    best = np.argmax(drops, axis = 2)
+    strength = np.take_along_axis(drops, best[:, :, None], axis = 2)[:, :, 0]
+    edges = np.take_along_axis(edgeR, best, axis = 1)
+    
+    #rays with a clear edge
+    median = np.partition(strength, rays // 2, axis = 1)[:, rays // 2, None]
+    good = strength > np.maximum(0.25 * median, 0)
+    
+    #least squares fit of x^2 + y^2 = a x + b y + c, around each centre
+    dx = cos[None, :] * edges
+    dy = sin[None, :] * edges
+    weight = good.astype("float64")
+    columns = np.stack([dx, dy, np.ones_like(dx)], axis = 2) * weight[:, :, None]
+    normal = np.einsum("nki,nkj->nij", columns, columns)
+    rhs = np.einsum("nki,nk->ni", columns, (dx * dx + dy * dy) * weight)
+    
+    enough = good.sum(axis = 1) >= rays // 2
+    normal[~enough] = np.eye(3)
+    solution = np.linalg.solve(normal, rhs[:, :, None])[:, :, 0]
+    
+    offsetX = solution[:, 0] / 2
+    offsetY = solution[:, 1] / 2
+    radius = np.sqrt(np.maximum(solution[:, 2] + offsetX ** 2 + offsetY ** 2, 0))
+    
+    refined = np.stack([circles[:, 0] + offsetX, circles[:, 1] + offsetY, radius], axis = 1)
+    found = (enough & (radius >= minR - 0.5) & (radius <= maxR + 0.5)
+             & (offsetX ** 2 + offsetY ** 2 <= band ** 2))
+    
+    return refined, found
 
 def findOverlapping(main, circles):
-    """Returns list of circles that overlap with main."""
+    """Returns list of circles that overlap with main.
+    circles is either a list of circles or a DropletGrid; only the nearby
+    cells of a DropletGrid are searched."""
+    if(isinstance(circles, DropletGrid)):
+        return circles.overlapping(main)
+    
     ret = []
 
     x1, y1, r1 = main
@@ -331,7 +1858,9 @@ def findOverlapping(main, circles):
 
 def analyzeImage(path, outputFolder, imgType,
                  minR = 5, maxR = 30, dp = 1, p1 = 15, p2 = 15,
-                 debug = False):
+                 debug = False, writer = None, profile = False, maxRefilter = 20,
+                 prescreen = True, detector = "hough", img = None, frame = None,
+                 saturation = None):
     """Analyzes an image for droplets.
     
     PARAMETERS:
@@ -346,82 +1875,237 @@ def analyzeImage(path, outputFolder, imgType,
         p1: param1 for HoughCircles. Lower values are more sensitive
         p2: param2 for HoughCircles. Lower values are more sensitive.
         debug: boolean, whether to write all debugging images
+        writer: ImageWriter to write the output images with. If None, they
+            are written before analyzeImage returns.
+        profile: boolean, whether to time each stage (see Image.getTimings)
+        maxRefilter: integer maximum number of times to re-filter a noisy 
+            image. Re-filtering also stops once it no longer changes the 
+            mask. Either way, "stopped" is written on the output image.
+        prescreen: boolean, whether to reject unusable frames (see 
+            screenFrame) before analyzing them. A rejected frame has no
+            droplets, the reason written on its output image and as its
+            status (see Image.getStatus), and the median of the whole frame.
+        detector: string name of the detector to find droplets with (see
+            DETECTORS): "hough" (HoughCircles, then re-searching overlaps), 
+            "distance" (distance transform peaks; faster, for separate
+            droplets) or "pyramid" (like hough, but finding candidates at
+            half resolution and refining them at full resolution)
+        img: the image at path, if it has already been read (e.g. by an 
+            ImageReader); otherwise, analyzeImage reads it
+        frame: integer index of the frame to analyze, if path is a TIFF 
+            stack (see imageFrames). Only that frame is read.
+        saturation: value at which the camera saturates, e.g. 4095 for a
+            12-bit camera saving 16-bit images. Used by the pre-screen and
+            the saturated pixel counts of the droplets. None uses the 
+            largest value of the image's type.
+    """
+    #timer: times the stages of the analysis, if profiling
+    timer = StageTimer(profile)
+    
+    timer.begin("read")
+    grayOrig = readImage(path, frame) if img is None else img
+    
+    #image names
+    if(frame is None):
+        print("\t{}".format(os.path.split(path)[1]))
+    else:
+        print("\t{} frame {}".format(os.path.split(path)[1], frame))
+    imgName = imageName(path, frame)
+    
+    result = analyzeFrame(grayOrig, minR, maxR, dp, p1, p2, debug, maxRefilter,
+                          prescreen, detector, timer, saturation = saturation)
+    
+    timer.begin("write")
+    steps, paths = writeSteps(result["steps"], outputFolder, imgName, debug, writer)
+    timer.end()
+
+    newImage = Image("{}.{}".format(imgName, imgType), result["droplets"], result["median"],
+                     steps, paths, timer.getTimings(),
+                     result["refilterCount"], result["refilterTime"], result["status"],
+                     frame)
+    timer.stop()
+
+    return newImage
+
+def analyzeFrame(grayOrig, minR = 5, maxR = 30, dp = 1, p1 = 15, p2 = 15,
+                 debug = False, maxRefilter = 20, prescreen = True, detector = "hough",
+                 timer = None, annotate = True, thresh = None, levels = None,
+                 arena = None, saturation = None):
+    """Finds the droplets in an 8-bit or 16-bit grayscale image (the work of
+    analyzeImage, without reading or writing files). The parameters are
+    described in analyzeImage. timer is the StageTimer to time the stages
+    with, if any. Without annotate, the droplets aren't drawn and there are
+    no step images.
+    
+    A frame that is part of a larger image (see analyzeMosaic) can be
+    analyzed as if it were the whole image: thresh is the (threshold, 
+    re-filter count) pair found for the whole image (see mosaicThreshold), 
+    used instead of thresholding and re-filtering the frame on its own, and
+    levels is the (low, high) pair normalize16 scales a 16-bit frame with.
+    
+    The scratch images are taken from arena (by default, this thread's; see
+    threadArena), so analyzing frames of the same size doesn't allocate
+    them again. In debug mode, where every step is kept, a new BufferArena 
+    is used.
+    
+    RETURNS:
+        dict of the DropletTable ("droplets"), the background median 
+        ("median"), the step images (name -> image; "steps"), the status
+        ("status"), and the re-filter count and time ("refilterCount", 
+        "refilterTime")
     """
-    gray = cv.imread(path, cv.IMREAD_ANYDEPTH)
+    if(detector not in DETECTORS):
+        raise ValueError("Unknown detector {}; use one of {}".format(
+            detector, ", ".join(DETECTORS.keys())))
+    finder = DETECTORS[detector](minR, maxR, dp, p1, p2)
+    
+    if(timer is None):
+        timer = StageTimer(False)
+    
+    #step images that are kept can't be reused for the next frame
+    if(debug):
+        arena = BufferArena()
+    elif(arena is None):
+        arena = threadArena()
+    
     #grayOrig is the same as gray if the image is 8-bit
     #if it is 16-bit, grayOrig is also 16-bit, while gray will be converted
-    grayOrig = np.copy(gray)
+    gray = grayOrig
     
     #If the image is 16-bit, convert gray to 8-bit
     if(gray.dtype == "uint16"):
-        gray = normalize16(gray)
-        
-    circled = cv.cvtColor(gray, cv.COLOR_GRAY2BGR)
+        gray = normalize16(gray, levels, arena.like("gray", gray, "uint8"))
     
-    #image names
-    imgName = os.path.split(path)[1]
-    print("\t{}".format(imgName))
-    #reformat imgName so there are no periods
-    imgName = imgName[:-4].replace("-", "_").replace(".", "-")
+    circled = None
+    if(annotate):
+        circled = cv.cvtColor(gray, cv.COLOR_GRAY2BGR,
+                              dst = arena.empty("circled", gray.shape + (3,)))
+    
+    #                   PRE-SCREENING
+    #Empty, saturated, over-bright and out of focus frames are rejected
+    #before the expensive steps. They still get a marked output image.
+    status = "ok"
+    if(prescreen):
+        timer.begin("prescreen")
+        status = screenFrame(grayOrig, gray, saturation = saturation)
+    
+    if(status != "ok"):
+        #the median of the whole frame
+        timer.begin("median")
+        imgMedian = medianMasked(grayOrig, None)
+        
+        allFiles = {}
+        if(annotate):
+            #the marked image is kept, so it can't stay in the arena
+            circled = cv.putText(np.copy(circled), "Rejected: {}".format(status),
+                                 (0, gray.shape[1]),
+                                 cv.FONT_HERSHEY_PLAIN, 3, (0, 0, 255))
+            
+            #in debug mode, the steps that weren't made are the marked image
+            allFiles = {fileName: circled for fileName in DEBUG_STEPS} if debug else {"final": circled}
+            if(debug):
+                allFiles["original"] = grayOrig
+        
+        return {"droplets": DropletTable(), "median": imgMedian, "steps": allFiles,
+                "status": status, "refilterCount": 0, "refilterTime": 0.0}
 
     #                   THRESHOLDING
     #Thresholding is meant to separate the droplets from the background of
     #the grayscale image. The method assumes that more pixels in the image
     #are of the dark background than of the bright droplets.
 
+    timer.begin("threshold")
+    #number of times the image was re-filtered, and how long it took
+    refilterCount = 0
+    refilterTime = 0.0
+    
     #thresh: threshold value to use
-    thresh = getThresh(gray)
+    if(thresh is None):
+        thresh = getThresh(gray, dst = arena.like("threshBlur", gray))
+        fixedThresh = False
+    else:
+        thresh, refilterCount = thresh
+        fixedThresh = True
     #threshed: thresholded image
-    threshed = threshold(gray, thresh)
+    threshed = threshold(gray, thresh, arena.like("threshed", gray))
     #gray image using threshed as a mask to remove the background
-    masked = cv.bitwise_and(gray, threshed)
+    masked = cv.bitwise_and(gray, threshed, dst = arena.like("masked", gray))
+    #the other mask buffer, for re-filtering
+    spareMasked = arena.like("refiltered", gray)
+    #a re-filtered mask is median blurred
+    if(fixedThresh and refilterCount > 0):
+        masked = cv.medianBlur(masked, 3, dst = spareMasked)
+    
+    #histogram of gray, which gives the mean of threshed for any thresh
+    grayHist = Histogram.fromImage(gray)
     
     #assume the mask being too white means it's too noisy
-    if(np.mean(threshed) > 40): #40 is arbitrarily; can adjust later
-        i = 1
+    if(not fixedThresh and grayHist.thresholdedMean(thresh) > 40): #40 is arbitrarily; can adjust later
+        timer.begin("refilter")
+        refilterStart = time.perf_counter()
+        
+        #histogram of masked, recounted whenever masked changes (calcHist
+        #is cheaper than finding and counting only the changed pixels)
+        maskedHist = Histogram.fromImage(masked)
+        #the thresh that made masked (the first masked is not blurred)
+        maskedThresh = None
+        stopped = False
         
         #re-threshold and mask the image until it is not so light
-        while(np.mean(threshed) > 40):
-            thresh = getThresh(masked, False)
-            threshed = threshold(gray, thresh)
-            masked = cv.bitwise_and(gray, threshed)
-            masked = cv.medianBlur(masked, 3)
+        while(grayHist.thresholdedMean(thresh) > 40):
+            newThresh = getThresh(masked, False, maskedHist)
+            
+            #stop if masked would not change any more, or after maxRefilter
+            if(newThresh == maskedThresh or refilterCount >= maxRefilter):
+                stopped = True
+                break
+            
+            thresh = newThresh
+            threshed = threshold(gray, thresh, threshed)
+            newMasked = cv.bitwise_and(gray, threshed, dst = arena.like("unfiltered", gray))
+            newMasked = cv.medianBlur(newMasked, 3, dst = spareMasked)
             
-            i += 1
+            maskedHist = Histogram.fromImage(newMasked)
+            masked, spareMasked = newMasked, masked
+            maskedThresh = thresh
+            
+            refilterCount += 1
+        
+        refilterTime = time.perf_counter() - refilterStart
         
         #adjust the output image to state that it has been re-filtered
-        circled = cv.putText(circled, "re-filtered {} time(s)".format(i), (5, 20),
-                             cv.FONT_HERSHEY_PLAIN, 1, (0, 0, 255))
+        #(counting the first filter)
+        note = "re-filtered {} time(s)".format(refilterCount + 1)
+        if(stopped):
+            note += ", stopped"
+        if(annotate):
+            circled = cv.putText(circled, note, (5, 20),
+                                 cv.FONT_HERSHEY_PLAIN, 1, (0, 0, 255))
+
+    #mean of threshed; over 150, the image is too poor to find droplets in
+    threshedMean = grayHist.thresholdedMean(thresh)
 
     #blur the masked image extensively
+    timer.begin("blur")
     #median blur helps remove stray white pixels from the background
-    blurMed1 = cv.medianBlur(masked, 3)
+    blurMed1 = cv.medianBlur(masked, 3, dst = arena.like("blurMed1", gray))
     #gaussian blur fills in droplets and makes them smoother
-    blurGaus = cv.GaussianBlur(blurMed1, (3,3), 1)
+    blurGaus = cv.GaussianBlur(blurMed1, (3,3), 1, dst = arena.like("blurGaus", gray))
     #some extra blurring (why?)
-    blurMed2 = cv.medianBlur(blurGaus, 5)
-    blurred = cv.GaussianBlur(blurMed2, (3,3), 1)
+    blurMed2 = cv.medianBlur(blurGaus, 5, dst = arena.like("blurMed2", gray))
+    blurred = cv.GaussianBlur(blurMed2, (3,3), 1, dst = arena.like("blurred", gray))
     
-    blurredThreshed = threshold(blurred, 0)         #for tooDark()
+    #for tooDark()
+    blurredThreshed = threshold(blurred, 0, arena.like("blurredThreshed", gray))
     
     #                   FIND DROPLETS
     #This section uses the blurred image, which should have cleanly
     #separated the droplets from the background, and attempts to identify
     #droplets (circles)
 
-    #use the HoughCircles function to detect circles
-    minDist = 2 * minR + 1
-    droplets = cv.HoughCircles(blurred, cv.HOUGH_GRADIENT,
-                               dp = dp, minDist = minDist,
-                               param1=p1, param2=p2,
-                               minRadius=minR, maxRadius = maxR)
-
-    #adjust the droplets to be in the desired format
-    if(droplets is not None and len(droplets.shape) == 3):
-        droplets = droplets[0]
-
-    if(droplets is not None):
-        droplets = droplets.round(0).astype(int).tolist()
+    #use the detector (by default, HoughCircles) to detect circles
+    timer.begin("detect")
+    droplets = finder.find(blurred, thresh)
 
     #initialize removed, which collects droplets deemed false positives
     removed = []
@@ -435,69 +2119,72 @@ def analyzeImage(path, outputFolder, imgType,
     
     #overlapping: image. Every droplet will be drawn on it very lightly
     #so lighter parts of overlapping are where multiple droplets overlap
-    overlapping = black(gray)
-    overlap2 = black(gray)
-    if((droplets is not None) and (np.mean(threshed) < 150)):
+    timer.begin("overlaps")
+    overlapping = arena.zeros("overlapping", gray.shape)
+    overlap2 = arena.zeros("overlap2", gray.shape)
+    if((droplets is not None) and (threshedMean < 150)):
+        #draw all of the detected circles once
+        labels = DropletLabels(gray.shape, droplets)
+        
         #search for droplets that are too dark (i.e. probably not droplets)
-        for drop in droplets:
-            if tooDark(blurredThreshed, drop):
-                removed.append(drop)
-            
+        #Cut-off value is 20% black; 10% is too low
+        dark = labels.fraction(labels.values(blurredThreshed) == 0) > 0.2
+        removed = [drop for drop, isDark in zip(droplets, dark) if isDark]
+        
         #remove dark droplets
-        for drop in removed:
-            droplets.remove(drop)
+        droplets = [drop for drop, isDark in zip(droplets, dark) if not isDark]
+        labels = labels.subset(~dark)
         
-        #mark all of the detected circles on overlapping
-        for (x, y, r) in droplets:
-            #draw the droplet very lightly on a black image
-            circleBase = cv.circle(black(gray), (x, y), r, 1, -1)
-            #add the droplet to overlapping
-            overlapping = overlapping + circleBase
+        #count how many droplets cover each pixel
+        #(uint8, so this wraps like adding uint8 images did)
+        np.copyto(overlapping, labels.coverage(), casting = "unsafe")
             
         #editOverlap is a black and white image indicating regions in
         #the miage where at least two droplets overlap
-        editOverlap = threshold(overlapping, 1)
-            
-        for (x, y, r) in droplets:
-            #draw the droplet very lightly on a black image (again)
-            circleBase = cv.circle(black(gray), (x, y), r, 1, -1)
-
-            #get the overlap between this droplet and editOverlap
-            bitAnd = np.bitwise_and(circleBase, editOverlap)
-
-            #if there at least one pixel of overlap, draw this
-            #droplet onto overlap2
-            if np.max(bitAnd) >= 1:
-                overlap2 = overlap2 + circleBase
+        editOverlap = threshold(overlapping, 1, arena.like("editOverlap", gray))
+        
+        #droplets with at least one pixel of overlap are drawn onto overlap2
+        inOverlap = labels.sum(labels.values(editOverlap) > 0) > 0
+        np.copyto(overlap2, labels.subset(inOverlap).coverage(), casting = "unsafe")
                 
     #clean overlap2 so all values are either black and white
     #no gray
-    overlap2 = threshold(overlap2, 0)        
+    overlap2 = threshold(overlap2, 0, overlap2)
         
     #initialize some images
-    overlapResult = black(gray)
-    markers = black(gray)
+    overlapResult = arena.zeros("overlapResult", gray.shape)
+    markers = arena.zeros("markers", gray.shape)
     
     #deal with overlapping droplets
-    if(np.max(overlapping) > 1):
+    if(finder.refineOverlaps and np.max(overlapping) > 1):
+        timer.begin("watershed")
         #to attempt to find the complete shape, where droplets overlap
         #use connectedComponents and watershed
-        retConnected, markers = cv.connectedComponents(overlap2)
-        markers = markers + 1
+        retConnected, labelled = cv.connectedComponents(
+            overlap2, labels = arena.like("labelled", gray, "int32"))
+        labelled += 1
         #unknown is region that is in the blurred image, but not overlap2
-        unknown = np.bitwise_xor(overlap2, threshold(blurred, 1))
-        markers[unknown == 255] = 0
+        unknown = np.bitwise_xor(overlap2, threshold(blurred, 1, arena.like("blurredMask", gray)),
+                                 out = arena.like("unknown", gray))
+        labelled[unknown == 255] = 0
         #watershed
-        markers = cv.watershed(cv.cvtColor(blurred, cv.COLOR_GRAY2BGR), markers)
+        labelled = cv.watershed(cv.cvtColor(blurred, cv.COLOR_GRAY2BGR,
+                                            dst = arena.empty("blurredBGR", gray.shape + (3,))),
+                                labelled)
         #make markers usable
-        markers[markers == -1] = 0
-        markers = np.uint8(markers)
-        markers = threshold(markers, 1)
+        labelled[labelled == -1] = 0
+        np.copyto(markers, labelled, casting = "unsafe")
+        markers = threshold(markers, 1, markers)
 
         #find contours
-        im, contours, hierarchy = cv.findContours(markers,
-                                                    cv.RETR_LIST,
-                                                    cv.CHAIN_APPROX_SIMPLE)
+        #(OpenCV 3 returns (image, contours, hierarchy), OpenCV 4 drops image)
+        contours = cv.findContours(markers,
+                                   cv.RETR_LIST,
+                                   cv.CHAIN_APPROX_SIMPLE)[-2]
+        
+        #keep the droplets in a DropletGrid so finding and removing the
+        #droplets that overlap a re-found droplet doesn't check every droplet
+        grid = DropletGrid(droplets, cellSize = 2 * maxR)
         
         #go through each contour
         for contour in contours:
@@ -506,15 +2193,15 @@ def analyzeImage(path, outputFolder, imgType,
                 #make a bounding rectangle from the contour
                 x, y, w, h = cv.boundingRect(contour)
                 
-                #overlapMask: mask to use when trying to re-find
-                #the big droplet. It is a rectangle slightly bigger
-                #than the bounding rectangle of the contour.
-                overlapMask = black(gray)
-                overlapMask = cv.rectangle(overlapMask,
-                                           (x - int(w / 4), y - int(h / 4)),
-                                           (x + int(w * 1.25), y + int(h * 1.25)),
-                                           255, -1)
-                #also draw the boundaries of the overlapMask
+                #the big droplet is re-found only inside a rectangle
+                #slightly bigger than the bounding rectangle of the contour
+                #(from x0, y0 to x1, y1 inclusive, cut off at the edges)
+                x0 = max(x - int(w / 4), 0)
+                y0 = max(y - int(h / 4), 0)
+                x1 = min(x + int(w * 1.25), gray.shape[1] - 1)
+                y1 = min(y + int(h * 1.25), gray.shape[0] - 1)
+                
+                #also draw the boundaries of that rectangle
                 #on overlapping (to view later for debugging etc.)
                 overlapping = cv.rectangle(overlapping,
                                            (x - int(w / 4), y - int(h / 4)),
@@ -527,9 +2214,10 @@ def analyzeImage(path, outputFolder, imgType,
                     blockSize += 1
                 
                 #mask the contour
-                maskedContour = cv.bitwise_and(overlapMask, markers)
+                maskedContour = markers[y0:y1 + 1, x0:x1 + 1]
                 #add the masked contour to overlapResult
-                overlapResult = cv.bitwise_or(overlapResult, maskedContour)
+                resultROI = overlapResult[y0:y1 + 1, x0:x1 + 1]
+                np.bitwise_or(resultROI, maskedContour, out = resultROI)
                 
                 #try to find droplets again, but with larger parameters
                 newMinDist = blockSize
@@ -537,8 +2225,15 @@ def analyzeImage(path, outputFolder, imgType,
                 newMaxR = blockSize
                 newP1 = int(p1 * 0.5)
                 newP2 = int(p2 * 0.5)
+                
+                #HoughCircles only needs the masked contour plus room for the
+                #centre of a circle of up to newMaxR around it, not the whole
+                #frame. The rest of that window is black, like the rest of
+                #the frame would be.
+                contourWindow, (wx, wy) = roiWindow(maskedContour, (x0, y0),
+                                                    gray.shape, newMaxR + 2, dp)
                                     
-                newDrops = cv.HoughCircles(maskedContour, cv.HOUGH_GRADIENT,
+                newDrops = cv.HoughCircles(contourWindow, cv.HOUGH_GRADIENT,
                                            dp = dp, minDist = newMinDist,
                                            param1 = newP1, param2 = newP2,
                                            minRadius = newMinR, maxRadius = newMaxR)
@@ -548,6 +2243,9 @@ def analyzeImage(path, outputFolder, imgType,
                     newDrops = newDrops[0]
 
                 if(newDrops is not None and len(newDrops) == 1):
+                    #move the droplets from window to frame coordinates
+                    newDrops[:, 0] += wx
+                    newDrops[:, 1] += wy
                     newDrops = newDrops.round(0).astype(int).tolist()
 
                     #add new droplets if they are valid
@@ -557,68 +2255,68 @@ def analyzeImage(path, outputFolder, imgType,
                             xD, yD, rD = drop
 
                             #remove other droplets that overlap with this new one
-                            dropsToRemove = findOverlapping(drop, droplets)
+                            dropsToRemove = findOverlapping(drop, grid)
                             
                             for dropRemove in dropsToRemove:
-                                droplets.remove(dropRemove)
+                                grid.remove(dropRemove)
                                 removed.append(dropRemove)
                             
                             #add the new one
-                            droplets.append(drop)
+                            grid.add(drop)
 
-                            overlapResult = cv.circle(overlapResult, (xD, yD), rD, 100, 1)
+                            overlapResult = drawCircles(overlapResult, [drop], 100)
+        
+        droplets = grid.toList()
         
     #if droplets were found, and are valid, write them to circled
-    if((droplets is not None) and (np.mean(threshed) < 150)):
-        for (x, y, r) in droplets:
-            circled = cv.circle(circled, (x, y), r, (255,0,0))
-            circled = cv.putText(circled, str(r), (int(x - r / 2), y), cv.FONT_HERSHEY_PLAIN, 1, (255, 0, 0))
-    #otherwise, write that the droplets were not found, or weren't valid
-    else:
-        circled = cv.putText(circled, "No droplets or image is poor quality",
-                             (0, gray.shape[1]),
-                             cv.FONT_HERSHEY_PLAIN, 3, (255, 0, 0))
-    
-    #make the final image as a copy of circled
-    final = np.copy(circled)
+    if(annotate):
+        timer.begin("annotate")
+        if((droplets is not None) and (threshedMean < 150)):
+            #the circles and their radii are the same colour, so the order
+            #they are drawn in doesn't matter
+            circled = drawCircles(circled, droplets, (255, 0, 0))
+            for (x, y, r) in droplets:
+                circled = cv.putText(circled, str(r), (int(x - r / 2), y), cv.FONT_HERSHEY_PLAIN, 1, (255, 0, 0))
+        #otherwise, write that the droplets were not found, or weren't valid
+        else:
+            circled = cv.putText(circled, "No droplets or image is poor quality",
+                                 (0, gray.shape[1]),
+                                 cv.FONT_HERSHEY_PLAIN, 3, (255, 0, 0))
+        
+        #make the final image as a copy of circled
+        final = np.copy(circled)
 
-    #write the removed droplets to circled, in red
-    if((removed is not None) and np.mean(threshed) < 150):
-        for (x, y, r) in removed:
-            circled = cv.circle(circled, (x, y), r, (0,0,255))
-            circled = cv.putText(circled, str(r), (int(x - r / 2), y), cv.FONT_HERSHEY_PLAIN, 1, (0, 0, 255))
+        #write the removed droplets to circled, in red
+        if((removed is not None) and threshedMean < 150):
+            circled = drawCircles(circled, removed, (0, 0, 255))
+            for (x, y, r) in removed:
+                circled = cv.putText(circled, str(r), (int(x - r / 2), y), cv.FONT_HERSHEY_PLAIN, 1, (0, 0, 255))
 
     #make Droplets (class instances) from the valid droplets
-    dropletInstances = []
-    if((droplets is not None) and (np.mean(threshed) < 150)):
-        for (x, y, r) in droplets:
-            mask = black(gray)
-            cv.circle(mask, (x, y), r, 255)
-            
-            mean = cv.mean(grayOrig, mask = mask)[0]
-            
-            newDroplet = Droplet(x, y, r, mean)
-            dropletInstances.append(newDroplet)
+    timer.begin("means")
+    dropletTable = DropletTable()
+    if((droplets is not None) and (threshedMean < 150)):
+        #the mean is taken over the outline of each droplet
+        outlines = DropletLabels(gray.shape, droplets, filled = False)
+        #and the other statistics over the filled disc
+        dropletTable = DropletTable.fromCircles(droplets, outlines.mean(grayOrig),
+                                                stats = dropletStats(grayOrig, droplets, saturation))
 
 
     #                   OUTPUT
-    #Create an ImageCollection and Images to summarize the output.
-    #In addition, write the output images.
+    #Summarize the output: the droplets, the background median and the
+    #step images to write.
 
     #get median of the background
-    inverseMask = black(gray)
-    inverseMask[blurredThreshed == 0] = 255
+    timer.begin("median")
+    inverseMask = cv.compare(blurredThreshed, 0, cv.CMP_EQ,
+                             dst = arena.like("inverseMask", gray))
     imgMedian = medianMasked(grayOrig, inverseMask)
 
-    if(debug):
-        #folder for the output image
-        subFolder = os.path.join(outputFolder, imgName)
-        try:
-            os.mkdir(subFolder)
-        except FileExistsError:
-            pass
-        
-        #all of the images
+    if(not annotate):
+        allFiles = {}
+    elif(debug):
+        #all of the images, in the order of DEBUG_STEPS
         allFiles = {"original": grayOrig,
                     "mask": threshed,
                     "blurred": blurred,
@@ -629,45 +2327,785 @@ def analyzeImage(path, outputFolder, imgType,
                     "final": final
                     }
 
-        newImage = Image("{}.{}".format(imgName, imgType), dropletInstances, imgMedian, allFiles)
+    else:
+        allFiles = {"final": final}
+
+    return {"droplets": dropletTable, "median": imgMedian, "steps": allFiles,
+            "status": "ok", "refilterCount": refilterCount, "refilterTime": refilterTime}
 
-        i = 0
 
-        for fileName in allFiles.keys():
-            cv.imwrite(os.path.join(subFolder, "{}-{}.png".format(i, fileName)), allFiles[fileName])
-            i += 1
+def writeSteps(allFiles, outputFolder, imgName, debug, writer = None):
+    """Writes the step images of analyzeImage (name -> image) to the output
+    folder (in debug mode, to its own subfolder) with writer, or before 
+    returning if writer is None.
+    
+    RETURNS:
+        steps: StepStore of the images
+        paths: dict of step name -> path it is written to
+    """
+    if(debug):
+        #folder for the output image
+        subFolder = os.path.join(outputFolder, imgName)
+        try:
+            os.mkdir(subFolder)
+        except FileExistsError:
+            pass
+    
+    paths = outputPaths(outputFolder, imgName, allFiles.keys(), debug)
+    steps = StepStore(allFiles, paths)
 
-    else:
-        allFiles = {"final": final}
-        newImage = Image("{}.{}".format(imgName, imgType), dropletInstances, imgMedian, allFiles)
+    #once written, steps are read back from the output folder when needed
+    if(writer is None):
+        writer = ImageWriter(threads = 0)
+    
+    for fileName in allFiles.keys():
+        writer.write(paths[fileName], allFiles[fileName],
+                     lambda fileName = fileName: steps.written(fileName))
+    
+    return steps, paths
+
+def analyzeImageWorker(args):
+    """Runs analyzeImage in a worker process of analyzeFolder.
+    
+    Only a small, picklable result (see imageResult) is sent back to the main
+    process. The steps themselves are read back from the output folder when
+    they are first needed.
+    """
+    path, frame, outputFolder, imgType, params, writerOptions, profile = args
+    
+    timer = StageTimer(profile)
+    
+    #the images must be written before the main process can read them
+    with ImageWriter(**writerOptions) as writer:
+        image = analyzeImage(path, outputFolder, imgType, writer = writer,
+                             profile = profile, frame = frame, **params)
+        
+        timer.begin("flush")
+        writer.flush()
+        timer.end()
+    
+    image.getTimings().update(timer.getTimings())
+    timer.stop()
+    
+    return imageResult(image)
+
+def imageResult(image):
+    """Returns the small, picklable result that represents an Image: a dict
+    of its name, the structured array of its DropletTable, its background
+    median, the paths of its step images, its timings, its re-filter count
+    and time, its status and its frame."""
+    return {"name": image.getName(),
+            "droplets": image.getDroplets().data,
+            "median": image.getMedian(),
+            "paths": image.getPaths(),
+            "timings": image.getTimings(),
+            "refilterCount": image.getRefilterCount(),
+            "refilterTime": image.getRefilterTime(),
+            "status": image.getStatus(),
+            "frame": image.getFrame()}
+
+def imageFromResult(result):
+    """Rebuilds an Image from an imageResult."""
+    return Image(result["name"], DropletTable(result["droplets"]), result["median"],
+                 StepStore(paths = result["paths"]), result["paths"], result["timings"],
+                 result["refilterCount"], result["refilterTime"], result["status"],
+                 result["frame"])
+
+def iterAnalyzeFolder(inputFolder, outputFolder, imgType,
+                      minR = 5, maxR = 30, dp = 1, p1 = 15, p2 = 15,
+                      debug = False, workers = 1,
+                      writerThreads = 2, pngCompression = None,
+                      cache = False, cacheFolder = None, report = None,
+                      maxRefilter = 20, prescreen = True, detector = "hough",
+                      prefetch = 2, saturation = None):
+    """Analyzes all images in the inputFolder like analyzeFolder, but yields
+    each Image as soon as it is ready instead of collecting them, so memory
+    use does not grow with the number of images. Use it with a DropletWriter
+    to write the .csv file as the results arrive:
+        
+        with DropletWriter(os.path.join(outputFolder, "dropletData")) as writer:
+            for image in iterAnalyzeFolder(inputFolder, outputFolder, "png"):
+                writer.write(image)
+    
+    workers is the number of processes to analyze images in. With 1, images
+    are analyzed one at a time in this process; None uses one process per CPU.
+    Either way, the Images are yielded in glob order.
+    
+    Output images are written by an ImageWriter with writerThreads threads
+    (0 writes them in line) and PNG compression level pngCompression (0-9; 
+    None is OpenCV's default). All of them have been written when the
+    generator finishes, and any write error is raised from it.
+    
+    With cache, results are kept in a ResultCache in cacheFolder (by default
+    the folder "dropletCache" in the inputFolder, so that it is found again
+    when the images are analyzed into another output folder), and images
+    whose content and parameters match a cached result are not analyzed 
+    again; their output images are copied from where they were written.
+    
+    With a RunReport as report, every stage of the run and of each analyzed
+    Image is timed, and each Image is added to the report as it is yielded.
+    
+    Multi-page TIFF (and OME-TIFF) stacks are analyzed one frame at a time,
+    each as its own Image (see imageFrames), in the order of the frames.
+    Only the frame being analyzed is read from the file.
+    
+    With 1 worker, an ImageReader reads the next prefetch images on a
+    background thread while one is analyzed (0 reads each image when it is
+    analyzed). How long the analysis waited for images and how long it
+    spent analyzing them is printed at the end, and added to the report.
+    
+    maxRefilter, prescreen, detector and saturation are passed to 
+    analyzeImage."""
+    params = {"minR": minR, "maxR": maxR, "dp": dp,
+              "p1": p1, "p2": p2, "debug": debug, "maxRefilter": maxRefilter,
+              "prescreen": prescreen, "detector": detector, "saturation": saturation}
+    writerOptions = {"threads": writerThreads, "pngCompression": pngCompression}
+    
+    if(workers is None):
+        workers = os.cpu_count()
+    elif(workers < 1):
+        raise ValueError("workers must be at least 1, or None")
+    
+    profile = report is not None
+    timer = report.timer if profile else StageTimer(False)
+    
+    #stop tracing memory once the run ends, however it ends
+    try:
+        #find all images
+        timer.begin("find images")
+        files, images = folderImages(inputFolder, imgType)
+
+        print("Analyzing {} .{} images in: {}".format(len(files),
+                                                      imgType,
+                                                      inputFolder))
+        if(len(images) != len(files)):
+            print("\t{} frames in all".format(len(images)))
+        
+        #look up every image in the cache
+        #keys[i] and cached[i] stay None without a cache or cached result
+        resultCache = None
+        keys = [None] * len(images)
+        cached = [None] * len(images)
         
-        cv.imwrite(os.path.join(outputFolder,  "{}.png".format(imgName)), final)
+        if(cache):
+            timer.begin("cache lookup")
+            if(cacheFolder is None):
+                cacheFolder = os.path.join(inputFolder, "dropletCache")
+            resultCache = ResultCache(cacheFolder)
+            
+            for i, (fn, frame) in enumerate(images):
+                keys[i] = resultCache.key(fn, params, frame)
+                stepNames = DEBUG_STEPS if debug else ["final"]
+                imgName = imageName(fn, frame)
+                cached[i] = resultCache.get(keys[i], outputPaths(outputFolder, imgName,
+                                                                 stepNames, debug),
+                                            "{}.{}".format(imgName, imgType), frame)
+            
+            print("\t{} of them are cached".format(len(images) - cached.count(None)))
+        
+        timer.end()
 
-    return newImage
+        if(workers == 1):
+            #Images whose steps are still being written, to cache once they are
+            toCache = []
+            
+            #read the images that aren't cached ahead of analyzing them
+            toRead = [image for image, result in zip(images, cached) if result is None]
+            
+            with ImageWriter(**writerOptions) as writer, \
+                 ImageReader(toRead, prefetch, read = lambda image: readImage(*image)) as reader:
+                #go through each image
+                for (fn, frame), key, result in zip(images, keys, cached):
+                    if(result is not None):
+                        newImage = imageFromResult(result)
+                    else:
+                        with timer.stage("wait for reads"):
+                            ignored, img = reader.get()
+                        
+                        newImage = analyzeImage(fn, outputFolder, imgType,
+                                                writer = writer, profile = profile,
+                                                img = img, frame = frame, **params)
+                        
+                        if(resultCache is not None):
+                            toCache.append((key, newImage))
+                            toCache = cacheWritten(resultCache, toCache)
+                    
+                    if(profile):
+                        report.add(newImage)
+                    yield newImage
+                
+                #wait for the last images to be written
+                with timer.stage("flush"):
+                    writer.flush()
+                
+                readStats = reader.stats()
+                if(readStats["images"] > 0):
+                    print("\tWaited {:.2f} s for images to be read, analyzed for {:.2f} s".format(
+                        readStats["waitSeconds"], readStats["computeSeconds"]))
+                if(profile):
+                    report.reads = readStats
+            
+            if(resultCache is not None):
+                cacheWritten(resultCache, toCache)
+        else:
+            #fan the images that aren't cached out to a process pool, 
+            #and yield the results in the original order. Only 2 * workers 
+            #images are in flight at a time, so that stopping the run (or an
+            #error) cancels the rest instead of waiting for all of them.
+            executor = processPool(workers)
+            try:
+                toSubmit = deque(i for i in range(len(images)) if cached[i] is None)
+                futures = {}
+                
+                for i, (key, result) in enumerate(zip(keys, cached)):
+                    while(len(toSubmit) > 0 and len(futures) < 2 * workers):
+                        j = toSubmit.popleft()
+                        fn, frame = images[j]
+                        futures[j] = executor.submit(analyzeImageWorker,
+                                                     (fn, frame, outputFolder, imgType, params,
+                                                      writerOptions, profile))
+                    
+                    if(result is None):
+                        #time spent waiting for the workers
+                        with timer.stage("wait for workers"):
+                            result = futures.pop(i).result()
+                        
+                        if(resultCache is not None):
+                            resultCache.put(key, result)
+                    
+                    newImage = imageFromResult(result)
+                    
+                    if(profile):
+                        report.add(newImage)
+                    yield newImage
+            finally:
+                executor.shutdown(wait = True, cancel_futures = True)
+    finally:
+        timer.stop()
+
+def cacheWritten(resultCache, toCache):
+    """Puts the (key, Image) pairs in toCache whose steps have all been
+    written into resultCache, and returns the ones that are still waiting."""
+    waiting = []
+    
+    for key, image in toCache:
+        if(image.getSteps().allWritten()):
+            resultCache.put(key, imageResult(image))
+        else:
+            waiting.append((key, image))
+    
+    return waiting
 
 def analyzeFolder(inputFolder, outputFolder, imgType,
                   minR = 5, maxR = 30, dp = 1, p1 = 15, p2 = 15,
-                  debug = False):
+                  debug = False, workers = 1,
+                  writerThreads = 2, pngCompression = None,
+                  cache = False, cacheFolder = None, profile = False,
+                  maxRefilter = 20, prescreen = True, detector = "hough",
+                  prefetch = 2, saturation = None):
     """Analyzes all images in the inputFolder with the imgType (e.g. png, jpg),
     and writes it to the output folder.
     Assumes the background is darker than the droplets, 
-    and that the majority of the image is background."""
-    #find all images
-    images = glob(os.path.join(inputFolder, "*.{}".format(imgType)))
-
-    print("Analyzing {} .{} images in: {}".format(len(images),
-                                                  imgType,
-                                                  inputFolder))
-
+    and that the majority of the image is background.
+    
+    workers, writerThreads, pngCompression, cache, cacheFolder and prefetch
+    are described in iterAnalyzeFolder, and maxRefilter, prescreen, detector
+    and saturation in analyzeImage. The Images are added to the collection in
+    glob order, and all output images have been written when analyzeFolder
+    returns.
+    
+    With profile, the collection gets a RunReport of how long each stage
+    took, which writeData writes next to the .csv file."""
     #create ImageCollection
     collection = ImageCollection()
-
-    #go through each image
-    for fn in images:
-        newImage = analyzeImage(fn, outputFolder, imgType,
-                                minR, maxR, dp, p1, p2, debug)
+    
+    report = None
+    if(profile):
+        report = RunReport()
+        collection.report = report
+
+    for newImage in iterAnalyzeFolder(inputFolder, outputFolder, imgType,
+                                      minR, maxR, dp, p1, p2, debug, workers,
+                                      writerThreads, pngCompression,
+                                      cache, cacheFolder, report, maxRefilter,
+                                      prescreen, detector, prefetch, saturation):
         collection.add(newImage)
 
-
     return collection
 
+
+#################### MOSAICS ####################
+
+def mosaicTiles(shape, tileSize, halo):
+    """Splits a frame of shape (height, width) into square tiles of tileSize
+    pixels (smaller at the right and bottom edges), each padded by a halo of
+    halo pixels on every side that is inside the frame.
+    
+    RETURNS:
+        list of (core, padded) tiles, each a (y0, y1, x0, x1) slice of the
+        frame, row by row
+    """
+    height, width = shape
+    tiles = []
+    
+    for y0 in range(0, height, tileSize):
+        for x0 in range(0, width, tileSize):
+            y1 = min(y0 + tileSize, height)
+            x1 = min(x0 + tileSize, width)
+            
+            padded = (max(y0 - halo, 0), min(y1 + halo, height),
+                      max(x0 - halo, 0), min(x1 + halo, width))
+            tiles.append(((y0, y1, x0, x1), padded))
+    
+    return tiles
+
+def mosaicThreshold(readGray, tiles, maxRefilter = 20):
+    """Finds the threshold analyzeFrame would find for a whole mosaic,
+    re-filtering included, from histograms summed over its tiles. The
+    threshold of the whole mosaic is steadier than that of each tile, whose
+    few droplets give a noisy histogram.
+    
+    PARAMETERS:
+        readGray: function that returns the 8-bit padded tile i of tiles
+        tiles: list of (core, padded) tiles from mosaicTiles
+        maxRefilter: as in analyzeImage
+    
+    RETURNS:
+        thresh: the threshold
+        refilterCount: number of times the mosaic was re-filtered
+        refilterTime: time it took to re-filter, in seconds
+    """
+    def sumHistograms(makeImages):
+        #Histograms of the tile cores of the images makeImages(gray) makes
+        totals = None
+        for i, ((y0, y1, x0, x1), padded) in enumerate(tiles):
+            images = makeImages(readGray(i))
+            counts = [Histogram.fromImage(img[y0 - padded[0]:y1 - padded[0],
+                                              x0 - padded[2]:x1 - padded[2]]).counts
+                      for img in images]
+            totals = counts if totals is None else [a + b for a, b in zip(totals, counts)]
+        
+        return [Histogram(counts, 8) for counts in totals]
+    
+    #the histograms of gray and of its blur (see getThresh)
+    grayHist, blurredHist = sumHistograms(
+        lambda gray: (gray, cv.GaussianBlur(gray, (5, 5), 1)))
+    thresh = getThresh(None, hist = blurredHist)
+    
+    refilterCount = 0
+    refilterStart = time.perf_counter()
+    
+    #re-filter like analyzeFrame, one pass over the tiles per re-filter
+    if(grayHist.thresholdedMean(thresh) > 40):
+        maskedHist, = sumHistograms(
+            lambda gray: (cv.bitwise_and(gray, threshold(gray, thresh)),))
+        maskedThresh = None
+        
+        while(grayHist.thresholdedMean(thresh) > 40):
+            newThresh = getThresh(None, False, maskedHist)
+            
+            if(newThresh == maskedThresh or refilterCount >= maxRefilter):
+                break
+            
+            thresh = newThresh
+            maskedHist, = sumHistograms(
+                lambda gray: (cv.medianBlur(cv.bitwise_and(gray, threshold(gray, thresh)), 3),))
+            maskedThresh = thresh
+            
+            refilterCount += 1
+    
+    return thresh, refilterCount, time.perf_counter() - refilterStart
+
+def analyzeTileWorker(args):
+    """Runs analyzeFrame on one tile of analyzeMosaic, in a worker process or
+    in line. Returns only what the mosaic needs: the structured array of the
+    tile's DropletTable, its median and its status."""
+    tile, params = args
+    
+    frame = analyzeFrame(tile, annotate = False, **params)
+    
+    return {"droplets": frame["droplets"].data,
+            "median": frame["median"],
+            "status": frame["status"]}
+
+def mergeTiles(tiles, results, shape, minR, maxR):
+    """Puts the droplets found in the tiles of a mosaic (see analyzeMosaic)
+    together in mosaic coordinates.
+    
+    Each tile keeps the droplets centred in its core; the halo is only there
+    so droplets near the core's edge are seen whole. A droplet on a seam can
+    still be found by the tiles on both sides of it, a pixel or so apart.
+    Droplets of different tiles whose centres are closer than 2 * minR + 1
+    (closer than HoughCircles allows in one frame) are the same droplet, and
+    only the one deepest inside its tile's core is kept.
+    
+    RETURNS:
+        DropletTable of the mosaic, in tile order
+    """
+    height, width = shape
+    tables = []
+    tileOf = []
+    depths = []
+    
+    for i, (((y0, y1, x0, x1), padded), result) in enumerate(zip(tiles, results)):
+        data = result["droplets"]
+        data["x"] += padded[2]
+        data["y"] += padded[0]
+        
+        x = data["x"]
+        y = data["y"]
+        data = data[(y0 <= y) & (y < y1) & (x0 <= x) & (x < x1)]
+        
+        #distance to the nearest seam; the mosaic's edges aren't seams
+        x = data["x"].astype("float64")
+        y = data["y"].astype("float64")
+        depth = np.full(len(data), np.inf)
+        if(x0 > 0):
+            depth = np.minimum(depth, x - x0)
+        if(x1 < width):
+            depth = np.minimum(depth, x1 - 1 - x)
+        if(y0 > 0):
+            depth = np.minimum(depth, y - y0)
+        if(y1 < height):
+            depth = np.minimum(depth, y1 - 1 - y)
+        
+        tables.append(data)
+        tileOf.append(np.full(len(data), i))
+        depths.append(depth)
+    
+    if(len(tables) == 0):
+        return DropletTable()
+    
+    data = np.concatenate(tables)
+    tileOf = np.concatenate(tileOf)
+    depths = np.concatenate(depths)
+    
+    #only droplets near a seam can have been found twice
+    minDist = 2 * minR + 1
+    keep = np.ones(len(data), dtype = bool)
+    grid = DropletGrid(cellSize = 2 * maxR)
+    tilesAt = {}
+    
+    nearSeam = np.flatnonzero(depths < minDist + maxR)
+    for i in nearSeam[np.argsort(-depths[nearSeam], kind = "stable")]:
+        x, y, r = int(data["x"][i]), int(data["y"][i]), int(data["r"][i])
+        
+        near = grid.overlapping((x, y, minDist))
+        if(any((x - x2) ** 2 + (y - y2) ** 2 < minDist ** 2
+               and tilesAt[(x2, y2, r2)] != {tileOf[i]}
+               for x2, y2, r2 in near)):
+            keep[i] = False
+            continue
+        
+        grid.add((x, y, r))
+        tilesAt.setdefault((x, y, r), set()).add(tileOf[i])
+    
+    return DropletTable(data[keep])
+
+def analyzeMosaic(path, outputFolder, imgType,
+                  minR = 5, maxR = 30, dp = 1, p1 = 15, p2 = 15,
+                  tileSize = 2048, halo = None, workers = 1,
+                  maxRefilter = 20, prescreen = True, detector = "hough",
+                  overviewSize = 4096, writer = None, profile = False, page = 0,
+                  saturation = None):
+    """Analyzes an image too large for analyzeImage, like a stitched mosaic
+    of the device, one tile at a time.
+    
+    The image is memory-mapped where possible (uncompressed TIFF files and
+    .npy files; see tiffFuncs.openImage), so only the tiles being analyzed
+    are read into memory. page is the page of a multi-page TIFF file to
+    analyze.
+    
+    PARAMETERS:
+        path, outputFolder, imgType, minR, maxR, dp, p1, p2, maxRefilter,
+            prescreen, detector, writer, profile, saturation: as in 
+            analyzeImage
+        tileSize: integer size of the tiles, in pixels
+        halo: integer number of pixels around each tile that are analyzed
+            with it, at least maxR so that a droplet centred in a tile is
+            whole. None uses 2 * maxR.
+        workers: number of processes to analyze tiles in. With 1, tiles are
+            analyzed in this process; None uses one process per CPU.
+        overviewSize: integer size of the longest side of the output image,
+            which is the mosaic (scaled down, if larger) with its droplets
+    
+    The tiles are analyzed with the threshold of the whole mosaic (see 
+    mosaicThreshold) and, if it is 16-bit, scaled to 8 bits with its minimum
+    and maximum, so they are analyzed as they would be in the whole image.
+    Each tile is pre-screened on its own. The droplets on seams between tiles
+    are only counted once (see mergeTiles). The median is the median of the 
+    tiles' medians, and the status is "ok" if any tile was ok. No debug 
+    images are written.
+    
+    RETURNS:
+        Image of the whole mosaic
+    """
+    if(halo is None):
+        halo = 2 * maxR
+    elif(halo < maxR):
+        raise ValueError("halo must be at least maxR ({})".format(maxR))
+    
+    if(workers is None):
+        workers = os.cpu_count()
+    
+    params = {"minR": minR, "maxR": maxR, "dp": dp, "p1": p1, "p2": p2,
+              "maxRefilter": maxRefilter, "prescreen": prescreen,
+              "detector": detector, "saturation": saturation}
+    
+    timer = StageTimer(profile)
+    
+    timer.begin("read")
+    mosaic = openImage(path, page)
+    dtype = mosaic.dtype.newbyteorder("=")
+    
+    print("\t{}".format(os.path.split(path)[1]))
+    imgName = imageName(path)
+    
+    tiles = mosaicTiles(mosaic.shape, tileSize, halo)
+    
+    #the output image, filled in as the tiles are read
+    scale = min(1.0, overviewSize / max(mosaic.shape))
+    overview = np.zeros((max(round(mosaic.shape[0] * scale), 1),
+                         max(round(mosaic.shape[1] * scale), 1)), dtype = dtype)
+    
+    def readTile(i):
+        py0, py1, px0, px1 = tiles[i][1]
+        return np.array(mosaic[py0:py1, px0:px1], dtype = dtype)
+    
+    #the range of a 16-bit mosaic, to scale every tile the same way
+    levels = None
+    if(dtype == "uint16"):
+        timer.begin("levels")
+        low, high = np.iinfo(dtype).max, 0
+        for i in range(len(tiles)):
+            tileMin, tileMax = cv.minMaxLoc(readTile(i))[:2]
+            low, high = min(low, tileMin), max(high, tileMax)
+        levels = (low, high)
+    
+    def readGray(i):
+        tile = readTile(i)
+        return normalize16(tile, levels) if levels is not None else tile
+    
+    timer.begin("threshold")
+    thresh, refilterCount, refilterTime = mosaicThreshold(readGray, tiles, maxRefilter)
+    params["thresh"] = (thresh, refilterCount)
+    params["levels"] = levels
+    
+    def tileArgs(i):
+        (y0, y1, x0, x1), (py0, py1, px0, px1) = tiles[i]
+        
+        with timer.stage("read"):
+            tile = readTile(i)
+            
+            core = tile[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+            oy0, oy1 = round(y0 * scale), round(y1 * scale)
+            ox0, ox1 = round(x0 * scale), round(x1 * scale)
+            if(oy1 > oy0 and ox1 > ox0):
+                overview[oy0:oy1, ox0:ox1] = cv.resize(core, (ox1 - ox0, oy1 - oy0),
+                                                       interpolation = cv.INTER_AREA)
+        
+        return (tile, params)
+    
+    results = [None] * len(tiles)
+    
+    timer.begin("analyze tiles")
+    if(workers == 1):
+        for i in range(len(tiles)):
+            results[i] = analyzeTileWorker(tileArgs(i))
+    else:
+        #keep only a few tiles in flight, so the mosaic is never all in memory
+        with processPool(workers) as executor:
+            futures = {}
+            for i in range(len(tiles)):
+                if(len(futures) >= 2 * workers):
+                    done, ignored = wait(futures.keys(), return_when = FIRST_COMPLETED)
+                    for future in done:
+                        results[futures.pop(future)] = future.result()
+                
+                futures[executor.submit(analyzeTileWorker, tileArgs(i))] = i
+            
+            for future, i in futures.items():
+                results[i] = future.result()
+    
+    timer.begin("merge")
+    dropletTable = mergeTiles(tiles, results, mosaic.shape, minR, maxR)
+    
+    statuses = [result["status"] for result in results]
+    status = "ok" if "ok" in statuses else max(set(statuses), key = statuses.count)
+    
+    medians = [result["median"] for result in results if result["status"] == status]
+    imgMedian = np.median(medians)
+    
+    timer.begin("annotate")
+    if(levels is not None):
+        overview = normalize16(overview, levels)
+    circled = cv.cvtColor(overview, cv.COLOR_GRAY2BGR)
+    
+    circles = np.stack([dropletTable.column("x") * scale, dropletTable.column("y") * scale,
+                        np.maximum(dropletTable.column("r") * scale, 1)], axis = 1)
+    circled = drawCircles(circled, circles.astype("int64"), (255, 0, 0))
+    
+    circled = cv.putText(circled, "{} droplets in {} tiles".format(len(dropletTable), len(tiles)),
+                         (5, 20), cv.FONT_HERSHEY_PLAIN, 1, (0, 0, 255))
+    
+    timer.begin("write")
+    steps, paths = writeSteps({"final": circled}, outputFolder, imgName, False, writer)
+    timer.end()
+    
+    image = Image("{}.{}".format(imgName, imgType), dropletTable, imgMedian,
+                  steps, paths, timer.getTimings(), refilterCount, refilterTime, status)
+    timer.stop()
+    
+    return image
+
+
+#################### WATCHING ####################
+
+def iterWatchFolder(inputFolder, outputFolder, imgType,
+                    minR = 5, maxR = 30, dp = 1, p1 = 15, p2 = 15,
+                    debug = False, workers = 1,
+                    writerThreads = 2, pngCompression = None,
+                    maxRefilter = 20, prescreen = True, detector = "hough",
+                    saturation = None, interval = 1.0, settle = 1.0, 
+                    idleTimeout = None, skip = ()):
+    """Watches the inputFolder for images with the imgType as they are
+    written to it (e.g. by DropletWashThrough during a run), and analyzes
+    each one with analyzeImage once it is complete (see FolderWatcher). 
+    Images already in the folder are analyzed first. Like 
+    iterAnalyzeFolder, each Image is yielded as soon as it is ready, so a 
+    DropletWriter can append it to the running .csv file:
+        
+        csvPath = os.path.join(outputFolder, "dropletData")
+        skip = csvImageNames(csvPath + ".csv") if os.path.exists(csvPath + ".csv") else ()
+        with DropletWriter(csvPath, append = True) as writer:
+            for image in iterWatchFolder(inputFolder, outputFolder, "png", skip = skip):
+                writer.write(image)
+    
+    PARAMETERS:
+        inputFolder, outputFolder, imgType, minR, maxR, dp, p1, p2, debug,
+            maxRefilter, prescreen, detector, saturation: as in analyzeImage
+        workers, writerThreads, pngCompression: as in iterAnalyzeFolder.
+            With more than 1 worker, new images are analyzed while earlier
+            ones are, and the Images are still yielded in the order their
+            files were found.
+        interval: float seconds between looking for new files
+        settle: float seconds a file must stay unchanged to be complete
+        idleTimeout: float seconds after which watching stops if no file
+            appeared or changed, and every image has been analyzed. None
+            watches until the generator is closed (e.g. by Ctrl+C).
+        skip: Image Names (as in the .csv file; see csvImageNames) not to
+            analyze again, e.g. when restarting during a run
+    
+    Multi-page TIFF stacks are analyzed one frame at a time once the whole
+    file is complete, and frames added to a stack later are analyzed once it
+    is complete again. An image that can't be analyzed (e.g. a file whose
+    writer paused for longer than settle, or that isn't an image) is 
+    reported instead of ending the run, and tried again once its file 
+    changes (see FolderWatcher.retry). Frames of a stack that were analyzed
+    are not analyzed again.
+    """
+    params = {"minR": minR, "maxR": maxR, "dp": dp,
+              "p1": p1, "p2": p2, "debug": debug, "maxRefilter": maxRefilter,
+              "prescreen": prescreen, "detector": detector, "saturation": saturation}
+    writerOptions = {"threads": writerThreads, "pngCompression": pngCompression}
+    
+    if(workers is None):
+        workers = os.cpu_count()
+    
+    watcher = FolderWatcher(inputFolder, imgType, settle)
+    skip = set(skip)
+    #Image Names of the images being analyzed, so a stack that changes
+    #meanwhile doesn't get them analyzed twice
+    queued = set()
+    stacks = imgType.lower() in ("tif", "tiff")
+    
+    print("Watching for .{} images in: {}".format(imgType, inputFolder))
+    
+    def newImages():
+        #(path, frame) of every image in the files that became complete
+        images = []
+        for fn in watcher.poll():
+            try:
+                frames = imageFrames(fn) if stacks else [None]
+            except Exception as e:
+                couldNotAnalyze(fn, None, e)
+                continue
+            
+            for frame in frames:
+                name = "{}.{}".format(imageName(fn, frame), imgType)
+                if(name not in skip and name not in queued):
+                    queued.add(name)
+                    images.append((fn, frame))
+        return images
+    
+    def analyzed(fn, frame):
+        name = "{}.{}".format(imageName(fn, frame), imgType)
+        queued.discard(name)
+        skip.add(name)
+    
+    def couldNotAnalyze(fn, frame, e):
+        queued.discard("{}.{}".format(imageName(fn, frame), imgType))
+        print("\tCould not analyze {}{}: {}".format(os.path.split(fn)[1],
+                                                    "" if frame is None else " frame {}".format(frame),
+                                                    e))
+        watcher.retry(fn)
+    
+    def idle():
+        return idleTimeout is not None and watcher.idleSeconds() >= idleTimeout
+    
+    if(workers == 1):
+        with ImageWriter(**writerOptions) as writer:
+            while(True):
+                images = newImages()
+                for fn, frame in images:
+                    try:
+                        newImage = analyzeImage(fn, outputFolder, imgType, writer = writer,
+                                                frame = frame, **params)
+                    except Exception as e:
+                        couldNotAnalyze(fn, frame, e)
+                        continue
+                    
+                    analyzed(fn, frame)
+                    yield newImage
+                
+                if(len(images) == 0):
+                    if(idle()):
+                        break
+                    time.sleep(interval)
+            
+            writer.flush()
+    else:
+        executor = processPool(workers)
+        try:
+            #(path, frame, future) of the images being analyzed, in order
+            running = deque()
+            
+            while(True):
+                for fn, frame in newImages():
+                    running.append((fn, frame,
+                                    executor.submit(analyzeImageWorker,
+                                                    (fn, frame, outputFolder, imgType, params,
+                                                     writerOptions, False))))
+                
+                #yield the finished ones, in order
+                while(len(running) > 0 and running[0][2].done()):
+                    fn, frame, future = running.popleft()
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        couldNotAnalyze(fn, frame, e)
+                        continue
+                    
+                    analyzed(fn, frame)
+                    yield imageFromResult(result)
+                
+                if(len(running) == 0 and idle()):
+                    break
+                
+                if(len(running) > 0):
+                    #wake up when the next image is done, or to poll again
+                    wait([running[0][2]], timeout = interval)
+                else:
+                    time.sleep(interval)
+        finally:
+            executor.shutdown(wait = True, cancel_futures = True)
@@ -15,7 +15,7 @@ import tkinter as tk
 from tkinter import filedialog
 import numpy as np
 
-from dropletAnalysisFuncs import analyzeFolder
+from dropletAnalysisFuncs import analyzeFolder, DETECTORS
 
 import os
 
@@ -280,7 +280,10 @@ class ImageViewerGUI:
     def viewImage(self, image):
         #set the name
         self.currName.set("Image: {} ({})".format(image.getName(), self.indexOfImage()))
-        self.numDroplets.set("Droplets: {}".format(len(image.getDroplets())))
+        if(image.getStatus() == "ok"):
+            self.numDroplets.set("Droplets: {}".format(len(image.getDroplets())))
+        else:
+            self.numDroplets.set("Droplets: 0 (rejected: {})".format(image.getStatus()))
     
         self.bgMedian.set("Background median: {}".format(image.getMedian()))
         
@@ -366,6 +369,11 @@ class ImageAnalysisGUI:
         self.debug = tk.Checkbutton(settingsCanvas, text = "Debug", variable = self.debugVariable)
         self.debug.grid(row = 0, column = 0, sticky = "W", padx = 5, pady = 5, columnspan = 2)
         
+        self.cacheVariable = tk.IntVar(root)
+        self.cacheVariable.set(1)
+        self.cache = tk.Checkbutton(settingsCanvas, text = "Reuse earlier results", variable = self.cacheVariable)
+        self.cache.grid(row = 4, column = 0, sticky = "W", padx = 5, pady = 5, columnspan = 2)
+        
         self.imgTypeLabel = tk.Label(settingsCanvas, text = "Image type")
         self.imgTypeVar = tk.StringVar(root)
         imgTypeValues = ["png", "jpg", "jpeg", "tif"]
@@ -404,6 +412,14 @@ class ImageAnalysisGUI:
         self.maxRLabel.grid(row = 2, column = 2, sticky = "E", padx = 5)
         self.maxR.grid(row = 2, column = 3, sticky = "W", padx = 5)
 
+        self.detectorLabel = tk.Label(settingsCanvas, text = "Detector")
+        self.detectorVar = tk.StringVar(root)
+        detectorValues = list(DETECTORS.keys())
+        self.detectorVar.set(detectorValues[0])
+        self.detector = tk.OptionMenu(settingsCanvas, self.detectorVar, *detectorValues)
+        self.detectorLabel.grid(row = 3, column = 2, sticky = "E", padx = 5)
+        self.detector.grid(row = 3, column = 3, sticky = "W", padx = 5)
+
         self.settingsCanvas.grid(row = i, columnspan = 2, padx = 10, pady = 5, sticky = "NEWS")
         
         #submit and related text
@@ -477,6 +493,7 @@ class ImageAnalysisGUI:
         #type validation & get values
         try:
             p["debug"] = bool(self.debugVariable.get())
+            p["cache"] = bool(self.cacheVariable.get())
             p["imgType"] = self.imgTypeVar.get()
             p["inputDir"] = self.inputFolderText.get()
             p["outputDir"] = self.outputFolderText.get()
@@ -485,6 +502,7 @@ class ImageAnalysisGUI:
             p["p2"] = float(self.p2.get())
             p["minR"] = int(self.minR.get())
             p["maxR"] = int(self.maxR.get())
+            p["detector"] = self.detectorVar.get()
         except ValueError:
             canProceed = False
             self.errorMsg("ERROR: inputs are bad")
@@ -520,7 +538,7 @@ class ImageAnalysisGUI:
             collection = analyzeFolder(p["inputDir"], p["outputDir"], p["imgType"],
                           p["minR"], p["maxR"], p["dp"],
                           p["p1"], p["p2"],
-                          p["debug"])
+                          p["debug"], cache = p["cache"], detector = p["detector"])
 
             csvName = os.path.join(p["outputDir"], "dropletData")
 
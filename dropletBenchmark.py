@@ -0,0 +1,579 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks dropletAnalysisFuncs.analyzeImage on synthetic droplet images made
+by dropletSynthetic, measuring both speed (images/s, droplets/s, peak
+allocated memory) and accuracy (precision and recall of the found droplets
+against the ground truth), so speed and accuracy regressions are caught
+together.
+
+When run, analyzes every scenario in SCENARIOS and prints a table. With
+--detectors hough distance, the detectors are benchmarked against each other
+on the same images. Results can be saved as .json and compared against an
+earlier run:
+
+    python dropletBenchmark.py --json before.json
+    (change dropletAnalysisFuncs)
+    python dropletBenchmark.py --compare before.json
+
+which exits with status 1 if any scenario got slower or less accurate.
+
+    python dropletBenchmark.py --parity pyramid
+
+instead checks that another detector finds (nearly) the same droplets as
+hough, the full resolution HoughCircles search.
+
+    python dropletBenchmark.py --mosaic
+
+instead checks that analyzeMosaic, which analyzes large images in tiles,
+finds (nearly) the same droplets as analyzing the whole image at once.
+
+    python dropletBenchmark.py --import-time [--json/--compare ...]
+
+instead times importing dropletAnalysisFuncs in a new interpreter, and
+exits with status 1 if importing it changes the working directory, imports
+a module in IMPORT_FORBIDDEN, or got slower than the saved run.
+"""
+
+import numpy as np
+import os
+import sys
+import json
+import time
+import tempfile
+import tracemalloc
+import argparse
+import subprocess
+
+import dropletAnalysisFuncs as daf
+import dropletSynthetic as synth
+
+#name -> keyword arguments of dropletSynthetic.makeDropletImage
+SCENARIOS = {
+    "sparse": {"density": 0.1, "overlap": 0},
+    "dense": {"density": 0.35, "overlap": 0.05},
+    "overlapping": {"density": 0.25, "overlap": 0.3},
+    "noisy": {"density": 0.2, "noise": 12, "gradient": 1.0},
+    "16-bit": {"density": 0.2, "bitDepth": 16},
+    "large": {"shape": (2048, 2048), "density": 0.25},
+}
+
+#how much worse than the baseline a result may be before it is a regression
+SPEED_TOLERANCE = 0.2       #fraction of images/s
+ACCURACY_TOLERANCE = 0.02   #absolute precision or recall
+
+#fraction of the hough detector's droplets another detector must reproduce
+#in a parity check
+PARITY_AGREEMENT = 0.9
+
+#size of the images of a mosaic check, and the fraction of the whole-image
+#droplets the tiles must reproduce (and vice versa)
+MOSAIC_SHAPE = (3072, 3072)
+MOSAIC_AGREEMENT = 0.99
+
+#modules that importing dropletAnalysisFuncs must not import, as they are
+#slow to import (or need a display) and are only needed for debugging
+IMPORT_FORBIDDEN = ["matplotlib", "tkinter", "multiprocessing"]
+
+#how much slower importing dropletAnalysisFuncs may get, in seconds, on top
+#of SPEED_TOLERANCE (imports are short, so their timings are noisy)
+IMPORT_SLACK = 0.01
+
+#run in a new interpreter by importTime: imports module (or only its
+#dependencies) and prints what it did as .json
+IMPORT_SCRIPT = """
+import json, os, sys, time
+cwd = os.getcwd()
+start = time.perf_counter()
+if(sys.argv[1] == "dependencies"):
+    import cv2, numpy
+else:
+    __import__(sys.argv[1])
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "changesDirectory": os.getcwd() != cwd,
+                  "modules": sorted(sys.modules)}))
+"""
+
+#################### ACCURACY ####################
+
+def matchPairs(found, truth, tolerance = 0.5):
+    """Matches found droplets to true droplets, closest pairs first. A pair
+    matches if the centres are less than tolerance * the true radius (and at
+    least 2 pixels) apart.
+
+    PARAMETERS:
+        found: array of (x, y, r) rows
+        truth: array of dropletSynthetic.TRUTH_DTYPE
+
+    RETURNS:
+        list of (index in found, index in truth) pairs
+    """
+    found = np.asarray(found, dtype = "float64").reshape(-1, 3)
+    if(len(found) == 0 or len(truth) == 0):
+        return []
+
+    dx = found[:, 0][:, None] - truth["x"][None, :]
+    dy = found[:, 1][:, None] - truth["y"][None, :]
+    distance = np.sqrt(dx * dx + dy * dy)
+    limit = np.maximum(tolerance * truth["r"], 2)[None, :]
+
+    pairs = np.argwhere(distance < limit)
+    pairs = pairs[np.argsort(distance[pairs[:, 0], pairs[:, 1]], kind = "stable")]
+
+    usedFound = np.zeros(len(found), dtype = bool)
+    usedTruth = np.zeros(len(truth), dtype = bool)
+    matches = []
+    for i, j in pairs:
+        if(not usedFound[i] and not usedTruth[j]):
+            usedFound[i] = True
+            usedTruth[j] = True
+            matches.append((int(i), int(j)))
+
+    return matches
+
+def matchDroplets(found, truth, tolerance = 0.5):
+    """Matches found droplets to true droplets like matchPairs.
+
+    RETURNS:
+        (true positives, false positives, false negatives)
+    """
+    matches = len(matchPairs(found, truth, tolerance))
+    return matches, len(found) - matches, len(truth) - matches
+
+def circlesAsTruth(circles):
+    """Returns (x, y, r) rows as a TRUTH_DTYPE array, to match against."""
+    circles = np.asarray(circles, dtype = "float64").reshape(-1, 3)
+    truth = np.zeros(len(circles), dtype = synth.TRUTH_DTYPE)
+    truth["x"], truth["y"], truth["r"] = circles.T
+    return truth
+
+def tableCircles(table):
+    """Returns the (x, y, r) rows of a DropletTable."""
+    data = table.data
+    return np.stack([data["x"], data["y"], data["r"]], axis = 1)
+
+#################### BENCHMARK ####################
+
+def benchmarkDataset(dataset, outputFolder, params = None, memoryImages = 2):
+    """Analyzes every (path, truth) pair of a data set with analyzeImage.
+
+    Throughput is timed without tracemalloc (which slows allocation down);
+    the peak allocated memory is measured by analyzing the first
+    memoryImages images again with tracemalloc on, each with an empty
+    BufferArena so its scratch images are counted. savedBytes is how many
+    bytes of scratch images the arena reused per image.
+
+    RETURNS:
+        dict of the results
+    """
+    if(params is None):
+        params = {}
+
+    truePos = falsePos = falseNeg = 0
+    dropletCount = 0
+
+    arena = daf.threadArena()
+    savedBefore = arena.savedBytes
+
+    start = time.perf_counter()
+    with daf.ImageWriter() as writer:
+        for path, truth in dataset:
+            image = daf.analyzeImage(path, outputFolder, "png", writer = writer, **params)
+
+            found = tableCircles(image.getDroplets())
+            dropletCount += len(found)
+
+            tp, fp, fn = matchDroplets(found, truth)
+            truePos += tp
+            falsePos += fp
+            falseNeg += fn
+    seconds = time.perf_counter() - start
+    savedBytes = arena.savedBytes - savedBefore
+
+    #memory
+    peakBytes = 0
+    wasTracing = tracemalloc.is_tracing()
+    if(not wasTracing):
+        tracemalloc.start()
+    for path, truth in dataset[:memoryImages]:
+        arena.clear()
+        tracemalloc.reset_peak()
+        allocated = tracemalloc.get_traced_memory()[0]
+
+        daf.analyzeImage(path, outputFolder, "png", **params)
+
+        peakBytes = max(peakBytes, tracemalloc.get_traced_memory()[1] - allocated)
+    if(not wasTracing):
+        tracemalloc.stop()
+
+    return {"images": len(dataset),
+            "droplets": dropletCount,
+            "seconds": seconds,
+            "imagesPerSecond": len(dataset) / seconds,
+            "dropletsPerSecond": dropletCount / seconds,
+            "peakBytes": peakBytes,
+            "savedBytes": savedBytes / len(dataset),
+            "precision": truePos / max(truePos + falsePos, 1),
+            "recall": truePos / max(truePos + falseNeg, 1)}
+
+def runSuite(scenarios = None, count = 5, params = None, seed = 0, detectors = ("hough",)):
+    """Generates count images for each scenario (names of SCENARIOS), in a
+    temporary folder, and benchmarks each detector (names of
+    dropletAnalysisFuncs.DETECTORS) on them.
+
+    RETURNS:
+        dict of "scenario" (or "scenario/detector", with more than one
+        detector) -> results of benchmarkDataset
+    """
+    if(scenarios is None):
+        scenarios = list(SCENARIOS.keys())
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as folder:
+        for name in scenarios:
+            inputFolder = os.path.join(folder, name)
+            dataset = synth.writeDataset(inputFolder, count, seed, **SCENARIOS[name])
+
+            for detector in detectors:
+                key = name if len(detectors) == 1 else "{}/{}".format(name, detector)
+
+                outputFolder = os.path.join(folder, "{}-{}-output".format(name, detector))
+                os.makedirs(outputFolder)
+
+                detectorParams = dict(params or {}, detector = detector)
+                results[key] = benchmarkDataset(dataset, outputFolder, detectorParams)
+
+    return results
+
+def parityCheck(dataset, outputFolder, detector, reference = "hough", params = None):
+    """Analyzes every image of a data set with both detector and reference
+    (names of dropletAnalysisFuncs.DETECTORS), and measures how much of the
+    reference's result detector reproduces.
+
+    RETURNS:
+        dict of the number of reference and detector droplets, the fraction
+        of reference droplets matched ("agreement"), the mean absolute 
+        difference in centre and radius of matched droplets, and the time
+        each took
+    """
+    if(params is None):
+        params = {}
+
+    counts = {"reference": 0, "detector": 0, "matched": 0}
+    centreDiffs = []
+    radiusDiffs = []
+    seconds = {reference: 0.0, detector: 0.0}
+
+    for path, truth in dataset:
+        circles = {}
+        for name in (reference, detector):
+            start = time.perf_counter()
+            image = daf.analyzeImage(path, outputFolder, "png", detector = name, **params)
+            seconds[name] += time.perf_counter() - start
+
+            circles[name] = tableCircles(image.getDroplets())
+
+        ref, new = circles[reference], circles[detector]
+        pairs = matchPairs(new, circlesAsTruth(ref))
+
+        counts["reference"] += len(ref)
+        counts["detector"] += len(new)
+        counts["matched"] += len(pairs)
+        for i, j in pairs:
+            centreDiffs.append(np.hypot(*(new[i, :2] - ref[j, :2])))
+            radiusDiffs.append(abs(new[i, 2] - ref[j, 2]))
+
+    return dict(counts,
+                agreement = counts["matched"] / max(counts["reference"], 1),
+                centreDifference = float(np.mean(centreDiffs)) if centreDiffs else 0.0,
+                radiusDifference = float(np.mean(radiusDiffs)) if radiusDiffs else 0.0,
+                referenceSeconds = seconds[reference],
+                detectorSeconds = seconds[detector])
+
+def runParity(detector, scenarios = None, count = 5, params = None, seed = 0):
+    """Runs parityCheck of detector against hough on count images of each
+    scenario.
+
+    RETURNS:
+        dict of scenario name -> results of parityCheck
+    """
+    if(scenarios is None):
+        scenarios = list(SCENARIOS.keys())
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as folder:
+        for name in scenarios:
+            inputFolder = os.path.join(folder, name)
+            outputFolder = os.path.join(folder, name + "-output")
+            os.makedirs(outputFolder)
+
+            dataset = synth.writeDataset(inputFolder, count, seed, **SCENARIOS[name])
+            results[name] = parityCheck(dataset, outputFolder, detector, params = params)
+
+    return results
+
+def mosaicCheck(dataset, outputFolder, tileSize = 1024, workers = 1, params = None):
+    """Analyzes every image of a data set both whole, with analyzeImage,
+    and in tiles of tileSize, with analyzeMosaic, and measures how closely
+    the tiles reproduce the whole image's droplets.
+
+    RETURNS:
+        dict of the number of whole-image and mosaic droplets, the fraction
+        of each matched by the other ("wholeAgreement", "mosaicAgreement"),
+        and the time each took
+    """
+    if(params is None):
+        params = {}
+
+    counts = {"whole": 0, "mosaic": 0, "matched": 0}
+    seconds = {"whole": 0.0, "mosaic": 0.0}
+
+    for path, truth in dataset:
+        start = time.perf_counter()
+        whole = daf.analyzeImage(path, os.path.join(outputFolder, "whole"), "png",
+                                 prescreen = False, **params)
+        seconds["whole"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        mosaic = daf.analyzeMosaic(path, os.path.join(outputFolder, "mosaic"), "png",
+                                   tileSize = tileSize, workers = workers,
+                                   prescreen = False, **params)
+        seconds["mosaic"] += time.perf_counter() - start
+
+        wholeCircles = tableCircles(whole.getDroplets())
+        mosaicCircles = tableCircles(mosaic.getDroplets())
+
+        counts["whole"] += len(wholeCircles)
+        counts["mosaic"] += len(mosaicCircles)
+        counts["matched"] += len(matchPairs(mosaicCircles, circlesAsTruth(wholeCircles)))
+
+    return dict(counts,
+                wholeAgreement = counts["matched"] / max(counts["whole"], 1),
+                mosaicAgreement = counts["matched"] / max(counts["mosaic"], 1),
+                wholeSeconds = seconds["whole"],
+                mosaicSeconds = seconds["mosaic"])
+
+def runMosaicCheck(scenarios = None, count = 5, tileSize = 1024, workers = 1,
+                   params = None, seed = 0):
+    """Runs mosaicCheck on count MOSAIC_SHAPE images of each scenario.
+
+    RETURNS:
+        dict of scenario name -> results of mosaicCheck
+    """
+    if(scenarios is None):
+        scenarios = list(SCENARIOS.keys())
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as folder:
+        for name in scenarios:
+            inputFolder = os.path.join(folder, name)
+            outputFolder = os.path.join(folder, name + "-output")
+            os.makedirs(os.path.join(outputFolder, "whole"))
+            os.makedirs(os.path.join(outputFolder, "mosaic"))
+
+            kwargs = dict(SCENARIOS[name], shape = MOSAIC_SHAPE)
+            dataset = synth.writeDataset(inputFolder, count, seed, **kwargs)
+            results[name] = mosaicCheck(dataset, outputFolder, tileSize, workers, params)
+
+    return results
+
+def printMosaic(results):
+    print("{: <12} {: >9} {: >9} {: >9} {: >9} {: >9} {: >9}".format(
+        "scenario", "whole", "mosaic", "whole ok", "mosaic ok", "whole s", "mosaic s"))
+
+    for name, result in results.items():
+        print("{: <12} {: >9} {: >9} {: >9.3f} {: >9.3f} {: >9.2f} {: >9.2f}".format(
+            name, result["whole"], result["mosaic"], result["wholeAgreement"],
+            result["mosaicAgreement"], result["wholeSeconds"], result["mosaicSeconds"]))
+
+def importTime(module = "dropletAnalysisFuncs", repeat = 5):
+    """Times importing module in a new interpreter, repeat times, and
+    importing just its dependencies (numpy and OpenCV), which no change to
+    it can make faster. The shortest time of each is kept. The interpreter
+    is started in a temporary folder, to see whether the import changes it.
+
+    RETURNS:
+        dict of the seconds the import took, the seconds of the dependencies
+        alone and the difference ("ownSeconds"), whether the import changed
+        the working directory, and which IMPORT_FORBIDDEN modules it imported
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join([folder, os.environ.get("PYTHONPATH", "")]))
+
+    def timeImport(name):
+        best = None
+        #the first run only writes the bytecode cache
+        for i in range(repeat + 1):
+            with tempfile.TemporaryDirectory() as cwd:
+                output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT, name],
+                                        cwd = cwd, env = env, check = True,
+                                        capture_output = True, text = True).stdout
+            result = json.loads(output.splitlines()[-1])
+            if(i > 0 and (best is None or result["seconds"] < best["seconds"])):
+                best = result
+        return best
+
+    imported = timeImport(module)
+    dependencies = timeImport("dependencies")
+
+    forbidden = [name for name in IMPORT_FORBIDDEN if name in imported["modules"]]
+
+    return {"seconds": imported["seconds"],
+            "dependencySeconds": dependencies["seconds"],
+            "ownSeconds": max(imported["seconds"] - dependencies["seconds"], 0),
+            "changesDirectory": imported["changesDirectory"],
+            "forbiddenModules": forbidden}
+
+def printImportTime(result):
+    print("import: {:.1f} ms ({:.1f} ms numpy and OpenCV, {:.1f} ms the rest)".format(
+        1000 * result["seconds"], 1000 * result["dependencySeconds"],
+        1000 * result["ownSeconds"]))
+
+def compareImportTime(result, baseline):
+    """Returns a list of messages describing every problem of result (from
+    importTime): side effects, and regressions against baseline (None, or
+    an earlier result)."""
+    problems = []
+
+    if(result["changesDirectory"]):
+        problems.append("import: changes the working directory")
+    for name in result["forbiddenModules"]:
+        problems.append("import: imports {}".format(name))
+
+    if(baseline is not None):
+        limit = (1 + SPEED_TOLERANCE) * baseline["ownSeconds"] + IMPORT_SLACK
+        if(result["ownSeconds"] > limit):
+            problems.append("import: {:.1f} ms, was {:.1f} ms".format(
+                1000 * result["ownSeconds"], 1000 * baseline["ownSeconds"]))
+
+    return problems
+
+def printParity(results):
+    print("{: <12} {: >9} {: >9} {: >9} {: >9} {: >9} {: >8}".format(
+        "scenario", "hough", "detector", "agreement", "centre", "radius", "speedup"))
+
+    for name, result in results.items():
+        print("{: <12} {: >9} {: >9} {: >9.3f} {: >9.2f} {: >9.2f} {: >8.2f}".format(
+            name, result["reference"], result["detector"], result["agreement"],
+            result["centreDifference"], result["radiusDifference"],
+            result["referenceSeconds"] / result["detectorSeconds"]))
+
+def printResults(results):
+    print("{: <21} {: >7} {: >9} {: >10} {: >10} {: >9} {: >9} {: >7}".format(
+        "scenario", "img/s", "drops/s", "peak MB", "reused MB", "precision", "recall", "drops"))
+
+    for name, result in results.items():
+        print("{: <21} {: >7.2f} {: >9.0f} {: >10.1f} {: >10.1f} {: >9.3f} {: >9.3f} {: >7}".format(
+            name, result["imagesPerSecond"], result["dropletsPerSecond"],
+            result["peakBytes"] / 2 ** 20, result.get("savedBytes", 0) / 2 ** 20,
+            result["precision"], result["recall"], result["droplets"]))
+
+def compareResults(results, baseline):
+    """Returns a list of messages describing every regression of results
+    against baseline (both from runSuite)."""
+    regressions = []
+
+    for name, result in results.items():
+        if(name not in baseline):
+            continue
+        old = baseline[name]
+
+        if(result["imagesPerSecond"] < (1 - SPEED_TOLERANCE) * old["imagesPerSecond"]):
+            regressions.append("{}: {:.2f} images/s, was {:.2f}".format(
+                name, result["imagesPerSecond"], old["imagesPerSecond"]))
+
+        for measure in ("precision", "recall"):
+            if(result[measure] < old[measure] - ACCURACY_TOLERANCE):
+                regressions.append("{}: {} {:.3f}, was {:.3f}".format(
+                    name, measure, result[measure], old[measure]))
+
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark droplet analysis on synthetic images.")
+    parser.add_argument("--count", type = int, default = 5,
+                        help = "images per scenario")
+    parser.add_argument("--scenarios", nargs = "+", choices = list(SCENARIOS.keys()),
+                        help = "scenarios to run (default: all)")
+    parser.add_argument("--detectors", nargs = "+", default = ["hough"],
+                        choices = list(daf.DETECTORS.keys()),
+                        help = "detectors to compare (default: hough)")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--json", help = "save the results to this .json file")
+    parser.add_argument("--compare", help = "compare against results saved with --json")
+    parser.add_argument("--parity", choices = list(daf.DETECTORS.keys()),
+                        help = "instead, check how closely this detector reproduces hough")
+    parser.add_argument("--mosaic", action = "store_true",
+                        help = "instead, check that analyzing large images in tiles finds the same droplets")
+    parser.add_argument("--tile-size", dest = "tileSize", type = int, default = 1024,
+                        help = "tile size of the mosaic check (default: 1024)")
+    parser.add_argument("--workers", type = int, default = 1,
+                        help = "processes to analyze the tiles of the mosaic check in (default: 1)")
+    parser.add_argument("--import-time", dest = "importTime", action = "store_true",
+                        help = "instead, time importing dropletAnalysisFuncs")
+    args = parser.parse_args()
+
+    if(args.mosaic):
+        results = runMosaicCheck(args.scenarios, args.count, args.tileSize, args.workers,
+                                 seed = args.seed)
+        printMosaic(results)
+
+        failed = [name for name, result in results.items()
+                  if min(result["wholeAgreement"], result["mosaicAgreement"]) < MOSAIC_AGREEMENT]
+        for name in failed:
+            print("MOSAIC {}: agreement {:.3f} / {:.3f}".format(
+                name, results[name]["wholeAgreement"], results[name]["mosaicAgreement"]))
+
+        sys.exit(1 if len(failed) > 0 else 0)
+
+    if(args.importTime):
+        result = importTime()
+        printImportTime(result)
+
+        if(args.json is not None):
+            with open(args.json, mode = "w") as jsonFile:
+                json.dump(result, jsonFile, indent = 4)
+
+        baseline = None
+        if(args.compare is not None):
+            with open(args.compare, mode = "r") as jsonFile:
+                baseline = json.load(jsonFile)
+
+        problems = compareImportTime(result, baseline)
+        for message in problems:
+            print("REGRESSION " + message)
+
+        sys.exit(1 if len(problems) > 0 else 0)
+
+    if(args.parity is not None):
+        results = runParity(args.parity, args.scenarios, args.count, seed = args.seed)
+        printParity(results)
+
+        failed = [name for name, result in results.items()
+                  if result["agreement"] < PARITY_AGREEMENT]
+        for name in failed:
+            print("PARITY {}: agreement {:.3f}".format(name, results[name]["agreement"]))
+
+        sys.exit(1 if len(failed) > 0 else 0)
+
+    results = runSuite(args.scenarios, args.count, seed = args.seed,
+                       detectors = args.detectors)
+    printResults(results)
+
+    if(args.json is not None):
+        with open(args.json, mode = "w") as jsonFile:
+            json.dump(results, jsonFile, indent = 4)
+
+    if(args.compare is not None):
+        with open(args.compare, mode = "r") as jsonFile:
+            baseline = json.load(jsonFile)
+
+        regressions = compareResults(results, baseline)
+        for message in regressions:
+            print("REGRESSION " + message)
+
+        if(len(regressions) > 0):
+            sys.exit(1)
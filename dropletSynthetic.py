@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Renders synthetic grayscale images of fluorescent droplets with known
+positions and radii (the ground truth), so dropletAnalysisFuncs can be tested
+and benchmarked away from the microscope room computer.
+
+Used by dropletBenchmark, but can be used independently. When run, writes a
+small example data set to the folder given on the command line.
+"""
+
+import cv2 as cv
+import numpy as np
+import os
+import csv
+import sys
+
+#one row of the ground truth of an image
+TRUTH_DTYPE = np.dtype([("x", "float64"), ("y", "float64"), ("r", "float64"),
+                        ("brightness", "float64"), ("overlapping", "bool")])
+
+#################### DROPLET PLACEMENT ####################
+
+def placeDroplets(shape, density, meanR, stdR, minR, maxR, overlap, rng):
+    """Picks droplet positions and radii until density of the frame is
+    covered (or no more droplets fit).
+
+    PARAMETERS:
+        shape: (height, width) of the frame
+        density: fraction of the frame to cover with droplets
+        meanR, stdR: mean and standard deviation of the radii, in pixels
+        minR, maxR: radii are clipped to this range
+        overlap: fraction of droplets that are placed overlapping another one
+        rng: np.random.Generator
+
+    RETURNS:
+        list of [x, y, r, overlapping] lists
+    """
+    height, width = shape
+    placed = []
+    covered = 0
+    failures = 0
+
+    while(covered < density * height * width and failures < 200):
+        r = float(np.clip(rng.normal(meanR, stdR), minR, maxR))
+
+        if(len(placed) > 0 and rng.random() < overlap):
+            #put it partway into a droplet that is already there
+            x2, y2, r2, ignored = placed[rng.integers(len(placed))]
+            angle = rng.uniform(0, 2 * np.pi)
+            distance = rng.uniform(0.6, 0.95) * (r + r2)
+            x = x2 + distance * np.cos(angle)
+            y = y2 + distance * np.sin(angle)
+            isOverlapping = True
+        else:
+            x = rng.uniform(0, width)
+            y = rng.uniform(0, height)
+            isOverlapping = False
+
+        #keep whole droplets inside the frame
+        if(not (r <= x < width - r and r <= y < height - r)):
+            failures += 1
+            continue
+
+        #separate droplets must not touch any other droplet
+        if(not isOverlapping):
+            if(any((x - x2) ** 2 + (y - y2) ** 2 < (r + r2 + 2) ** 2
+                   for x2, y2, r2, ignored in placed)):
+                failures += 1
+                continue
+
+        failures = 0
+        placed.append([x, y, r, isOverlapping])
+        covered += np.pi * r * r
+
+        #the droplet it overlaps is overlapping too
+        if(isOverlapping):
+            for drop in placed[:-1]:
+                if((x - drop[0]) ** 2 + (y - drop[1]) ** 2 < (r + drop[2]) ** 2):
+                    drop[3] = True
+
+    return placed
+
+#################### RENDERING ####################
+
+def makeDropletImage(shape = (1024, 1024), density = 0.2,
+                     meanR = 14, stdR = 3, minR = 6, maxR = 28,
+                     overlap = 0.05, noise = 4, background = 20, gradient = 0.5,
+                     brightness = (120, 220), blur = 1.2, bitDepth = 8, seed = None):
+    """Renders a grayscale image of fluorescent droplets on a dark background.
+
+    PARAMETERS:
+        shape: (height, width) of the image
+        density: fraction of the image covered by droplets
+        meanR, stdR: mean and standard deviation of droplet radii, in pixels
+        minR, maxR: droplet radii are clipped to this range
+        overlap: fraction of droplets placed overlapping another droplet
+        noise: standard deviation of the Gaussian noise, in 8-bit levels
+        background: mean brightness of the background, in 8-bit levels
+        gradient: how much the background brightness changes from the left
+            to the right edge, as a fraction of background
+        brightness: (low, high) range of droplet brightness, in 8-bit levels
+        blur: sigma of the Gaussian blur of the optics, in pixels
+        bitDepth: 8 or 16. 16-bit images use 12 bits, like the camera.
+        seed: seed for the random numbers, to get the same image again
+
+    RETURNS:
+        img: uint8 or uint16 image
+        truth: array of TRUTH_DTYPE with every droplet in the image
+    """
+    if(bitDepth not in (8, 16)):
+        raise ValueError("bitDepth must be 8 or 16")
+
+    rng = np.random.default_rng(seed)
+    height, width = shape
+
+    placed = placeDroplets(shape, density, meanR, stdR, minR, maxR, overlap, rng)
+
+    truth = np.zeros(len(placed), dtype = TRUTH_DTYPE)
+    for i, (x, y, r, isOverlapping) in enumerate(placed):
+        truth[i] = (x, y, r, rng.uniform(*brightness), isOverlapping)
+
+    #draw the droplets with sub-pixel centres and radii
+    shift = 4
+    scale = 2 ** shift
+    img = np.zeros(shape, dtype = "float32")
+    for drop in truth:
+        cv.circle(img, (int(round(drop["x"] * scale)), int(round(drop["y"] * scale))),
+                  int(round(drop["r"] * scale)), float(drop["brightness"]), -1,
+                  cv.LINE_AA, shift)
+
+    if(blur > 0):
+        img = cv.GaussianBlur(img, (0, 0), blur)
+
+    #background that gets brighter from left to right
+    ramp = np.linspace(1 - gradient / 2, 1 + gradient / 2, width, dtype = "float32")
+    img += background * ramp[None, :]
+
+    img += rng.normal(0, noise, shape).astype("float32")
+
+    if(bitDepth == 8):
+        img = np.clip(np.round(img), 0, 255).astype("uint8")
+    else:
+        img = np.clip(np.round(img * 16), 0, 4095).astype("uint16")
+
+    return img, truth
+
+#################### DATA SETS ####################
+
+def writeTruth(path, truth):
+    """Writes the ground truth of an image as a .csv file."""
+    with open(path, mode = "w") as csvFile:
+        writer = csv.writer(csvFile, dialect = "excel")
+        writer.writerow(TRUTH_DTYPE.names)
+        writer.writerows(truth.tolist())
+
+def readTruth(path):
+    """Reads the ground truth written by writeTruth."""
+    with open(path, mode = "r") as csvFile:
+        reader = csv.reader(csvFile, dialect = "excel")
+        next(reader)
+        rows = [(float(x), float(y), float(r), float(b), o == "True")
+                for x, y, r, b, o in reader]
+
+    return np.array(rows, dtype = TRUTH_DTYPE)
+
+def writeDataset(folder, count, seed = 0, **kwargs):
+    """Writes count synthetic images to folder as synth000.png, ... with
+    their ground truth in synth000-truth.csv, ... The kwargs are passed to
+    makeDropletImage; image i uses seed + i.
+
+    RETURNS:
+        list of (image path, truth) pairs
+    """
+    os.makedirs(folder, exist_ok = True)
+    dataset = []
+
+    for i in range(count):
+        img, truth = makeDropletImage(seed = seed + i, **kwargs)
+
+        path = os.path.join(folder, "synth{:03d}.png".format(i))
+        cv.imwrite(path, img)
+        writeTruth(os.path.join(folder, "synth{:03d}-truth.csv".format(i)), truth)
+
+        dataset.append((path, truth))
+
+    return dataset
+
+if __name__ == "__main__":
+    if(len(sys.argv) < 2):
+        print("usage: dropletSynthetic.py outputFolder [count]")
+        sys.exit(1)
+
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    writeDataset(sys.argv[1], count)
+    print("Wrote {} images to {}".format(count, sys.argv[1]))
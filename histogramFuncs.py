@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vectorized histogram statistics of grayscale images: the mode (brightest
+background peak), the valley search used to pick a threshold, and counts
+above a threshold. 16-bit images can be binned at a reduced resolution.
+
+Used by dropletAnalysisFuncs, but can be used independently.
+"""
+
+import cv2 as cv
+import numpy as np
+
+class Histogram:
+    """Histogram of an 8-bit or 16-bit grayscale image, optionally under a
+    mask. bits sets the number of bins (2 ** bits); by default every value
+    has its own bin. Each bin holds 2 ** shift values.
+    """
+    def __init__(self, counts, depth, shift = 0):
+        self.counts = counts
+        self.depth = depth
+        self.shift = shift
+
+    @classmethod
+    def fromImage(cls, img, mask = None, bits = None):
+        """Makes the Histogram of img (uint8 or uint16), counting only the
+        pixels where mask (if given) is not 0."""
+        if(len(img.shape) != 2):
+            raise Exception("img is not 2-dimensional")
+        elif(mask is not None and len(mask.shape) != 2):
+            raise Exception("mask is not 2-dimensional")
+
+        if(img.dtype == "uint8"):
+            depth = 8
+        elif(img.dtype == "uint16"):
+            depth = 16
+        else:
+            raise TypeError("img is not of type uint8 or uint16")
+
+        if(bits is None):
+            bits = depth
+        elif(not 1 <= bits <= depth):
+            raise ValueError("bits must be between 1 and {}".format(depth))
+
+        counts = cv.calcHist([img], [0], mask, [2 ** bits], (0, 2 ** depth))
+
+        return cls(counts.ravel().astype("int64"), depth, depth - bits)
+
+    def __repr__(self):
+        return "Histogram({} bins of {} values)".format(len(self.counts), 2 ** self.shift)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def total(self):
+        """Returns the number of pixels counted."""
+        return int(self.counts.sum())
+
+    def value(self, index):
+        """Returns the lowest image value of bin index."""
+        return index << self.shift
+
+    def mode(self):
+        """Returns the index of the fullest bin, skipping bin 0 (the black,
+        masked-out pixels). Ties go to the lowest index."""
+        return 1 + int(np.argmax(self.counts[1:]))
+
+    def valley(self, start):
+        """Starting at bin start, follows the histogram while it does not
+        increase. Returns the index of the bin before it first increases,
+        or start if it never does."""
+        if(start + 1 >= len(self.counts)):
+            return start
+
+        rising = np.flatnonzero(self.counts[start + 1:] > self.counts[start:-1])
+        if(len(rising) == 0):
+            return start
+
+        return start + int(rising[0])
+
+    def threshold(self, offset = 4):
+        """Returns the bin index to threshold at: the valley after the mode
+        (see getThresh in dropletAnalysisFuncs)."""
+        return self.valley(self.mode() + offset)
+
+    def countAbove(self, index):
+        """Returns the number of pixels in bins above index."""
+        return int(self.counts[index + 1:].sum())
+
+    def thresholdedMean(self, thresh):
+        """Returns the mean of the image thresholded (THRESH_BINARY, to 255)
+        at bin thresh, without thresholding it."""
+        return 255 * self.countAbove(thresh) / self.total()
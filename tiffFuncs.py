@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reads the pages of uncompressed grayscale TIFF files (as written by
+Micro-Manager and by stitching software) as memory-mapped NumPy arrays, so
+that large images and long stacks are read from disk only where they are
+used, instead of being decoded into memory all at once.
+
+Only what is needed for that is supported: classic TIFF and BigTIFF, in
+either byte order, with 8- or 16-bit grayscale pages stored uncompressed in
+one contiguous run of strips. openImage, frameCount and readFrame fall back
+to OpenCV for anything else.
+
+Used by dropletAnalysisFuncs, but can be used independently.
+"""
+
+import cv2 as cv
+import numpy as np
+import os
+import struct
+from functools import lru_cache
+
+#TIFF tags that are read
+TAG_WIDTH = 256
+TAG_LENGTH = 257
+TAG_BITS = 258
+TAG_COMPRESSION = 259
+TAG_DESCRIPTION = 270
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES = 277
+TAG_STRIP_COUNTS = 279
+TAG_PLANAR = 284
+TAG_TILE_WIDTH = 322
+TAG_SAMPLE_FORMAT = 339
+
+#TIFF field type -> struct format of one value
+FIELD_FORMATS = {1: "B", 2: "s", 3: "H", 4: "I", 6: "b", 8: "h", 9: "i",
+                 16: "Q", 17: "q"}
+
+class TiffError(ValueError):
+    #the file is not a TIFF file, or its pages can't be memory-mapped
+    pass
+
+class TiffPage:
+    #one page (image) of a TIFF file: where its pixels are, and its size
+    def __init__(self, path, index, shape, dtype, offset, description = None):
+        self.path = path
+        self.index = index
+        self.shape = shape
+        self.dtype = dtype
+        self.offset = offset
+        self.description = description
+
+    def __repr__(self):
+        return "<TiffPage {} of {}: {}x{} {}>".format(self.index, self.path,
+                                                     self.shape[1], self.shape[0],
+                                                     self.dtype.name)
+
+    def asarray(self):
+        """Returns the page as a read-only np.memmap. Its dtype may not be in
+        the native byte order; np.array(page, dtype = "uint16") fixes that."""
+        return np.memmap(self.path, dtype = self.dtype, mode = "r",
+                         offset = self.offset, shape = self.shape)
+
+def readEntry(fileObj, order, bigTiff):
+    """Reads one IFD entry at the current position of fileObj.
+
+    RETURNS:
+        tag, list of values (or bytes, for ASCII fields)
+    """
+    if(bigTiff):
+        tag, fieldType, count = struct.unpack(order + "HHQ", fileObj.read(12))
+        raw = fileObj.read(8)
+    else:
+        tag, fieldType, count = struct.unpack(order + "HHI", fileObj.read(8))
+        raw = fileObj.read(4)
+
+    fmt = FIELD_FORMATS.get(fieldType)
+    if(fmt is None):
+        return tag, None
+
+    size = struct.calcsize(fmt) * count
+    if(size > len(raw)):
+        #the values are stored elsewhere; raw is their offset
+        offset = struct.unpack(order + ("Q" if bigTiff else "I"), raw)[0]
+        resume = fileObj.tell()
+        fileObj.seek(offset)
+        raw = fileObj.read(size)
+        fileObj.seek(resume)
+
+    if(fmt == "s"):
+        return tag, raw[:size].rstrip(b"\0")
+
+    return tag, list(struct.unpack(order + fmt * count, raw[:size]))
+
+def readPages(path):
+    """Reads the IFDs (page headers) of the TIFF file at path. They are only
+    read again if the file changes.
+
+    RETURNS:
+        list of TiffPages, in file order
+
+    Raises TiffError if the file isn't a TIFF file, or if a page is not
+    uncompressed 8- or 16-bit grayscale in contiguous strips."""
+    stat = os.stat(path)
+    return list(readPagesOf(path, stat.st_size, stat.st_mtime_ns))
+
+@lru_cache(maxsize = 32)
+def readPagesOf(path, size, mtime):
+    #readPages of the file at path with that size and modification time
+    try:
+        return parsePages(path, size)
+    except struct.error:
+        #a read came up short, so there were too few bytes to unpack
+        raise TiffError("{} is truncated".format(path))
+
+def parsePages(path, size):
+    #reads the TiffPages of the IFDs of a file of size bytes
+    with open(path, "rb") as fileObj:
+        header = fileObj.read(4)
+        if(header[:2] == b"II"):
+            order = "<"
+        elif(header[:2] == b"MM"):
+            order = ">"
+        else:
+            raise TiffError("{} is not a TIFF file".format(path))
+
+        version = struct.unpack(order + "H", header[2:])[0]
+        if(version == 42):
+            bigTiff = False
+            nextIFD = struct.unpack(order + "I", fileObj.read(4))[0]
+        elif(version == 43):
+            bigTiff = True
+            fileObj.read(4)
+            nextIFD = struct.unpack(order + "Q", fileObj.read(8))[0]
+        else:
+            raise TiffError("{} is not a TIFF file".format(path))
+
+        pages = []
+        seen = set()
+        while(nextIFD != 0 and nextIFD not in seen):
+            seen.add(nextIFD)
+            fileObj.seek(nextIFD)
+
+            if(bigTiff):
+                count = struct.unpack(order + "Q", fileObj.read(8))[0]
+            else:
+                count = struct.unpack(order + "H", fileObj.read(2))[0]
+
+            tags = {}
+            for i in range(count):
+                tag, values = readEntry(fileObj, order, bigTiff)
+                tags[tag] = values
+
+            pages.append(makePage(path, len(pages), tags, order, size))
+
+            if(bigTiff):
+                nextIFD = struct.unpack(order + "Q", fileObj.read(8))[0]
+            else:
+                nextIFD = struct.unpack(order + "I", fileObj.read(4))[0]
+
+    return tuple(pages)
+
+def makePage(path, index, tags, order, size):
+    """Makes the TiffPage of the IFD tags (tag -> values) of page index,
+    checking that it can be memory-mapped from a file of size bytes."""
+    def first(tag, default = None):
+        values = tags.get(tag)
+        return default if values is None else values[0]
+
+    where = "page {} of {}".format(index, path)
+
+    if(first(TAG_COMPRESSION, 1) != 1):
+        raise TiffError("{} is compressed".format(where))
+    if(first(TAG_SAMPLES, 1) != 1):
+        raise TiffError("{} is not grayscale".format(where))
+    if(TAG_TILE_WIDTH in tags):
+        raise TiffError("{} is stored in tiles".format(where))
+    if(first(TAG_SAMPLE_FORMAT, 1) != 1):
+        raise TiffError("{} is not unsigned integers".format(where))
+
+    bits = first(TAG_BITS, 1)
+    if(bits not in (8, 16)):
+        raise TiffError("{} is {}-bit".format(where, bits))
+    dtype = np.dtype("uint8" if bits == 8 else "uint16").newbyteorder(order)
+
+    shape = (first(TAG_LENGTH), first(TAG_WIDTH))
+    offsets = tags.get(TAG_STRIP_OFFSETS)
+    counts = tags.get(TAG_STRIP_COUNTS)
+    if(None in shape or offsets is None):
+        raise TiffError("{} has no image data".format(where))
+
+    #the strips must follow each other, so the page is one block of the file
+    if(counts is not None and len(offsets) > 1):
+        ends = np.add(offsets[:-1], counts[:-1])
+        if(np.any(ends != offsets[1:])):
+            raise TiffError("{} is not stored contiguously".format(where))
+
+    if(offsets[0] + shape[0] * shape[1] * dtype.itemsize > size):
+        raise TiffError("{} is truncated".format(where))
+
+    description = tags.get(TAG_DESCRIPTION)
+    if(description is not None):
+        description = description.decode("utf-8", "replace")
+
+    return TiffPage(path, index, shape, dtype, offsets[0], description)
+
+def isTiff(path):
+    return os.path.splitext(path)[1].lower() in (".tif", ".tiff")
+
+def openImage(path, page = 0):
+    """Opens a grayscale image without decoding all of it, if possible:
+    TIFF pages (see readPages) and .npy files are memory-mapped, and other
+    images are read with cv.imread.
+
+    RETURNS:
+        2-dimensional array (np.memmap, if memory-mapped)
+    """
+    if(path.lower().endswith(".npy")):
+        return np.load(path, mmap_mode = "r")
+
+    if(isTiff(path)):
+        try:
+            return readPages(path)[page].asarray()
+        except TiffError:
+            if(page != 0):
+                raise
+
+    img = cv.imread(path, cv.IMREAD_ANYDEPTH)
+    if(img is None):
+        raise IOError("Could not read {}".format(path))
+
+    return img
+
+def frameCount(path):
+    """Returns the number of frames (pages) of a TIFF stack; 1 for other
+    images. Raises IOError if neither readPages nor OpenCV can read it."""
+    if(not isTiff(path)):
+        return 1
+
+    try:
+        return len(readPages(path))
+    except TiffError:
+        count = cv.imcount(path)
+
+    if(count == 0):
+        raise IOError("Could not read {}".format(path))
+
+    return count
+
+def readFrame(path, frame):
+    """Reads frame (page) frame of a TIFF stack, reading only that frame's
+    part of the file if it can be memory-mapped.
+
+    RETURNS:
+        2-dimensional array, in the native byte order
+    """
+    try:
+        page = readPages(path)[frame]
+    except TiffError:
+        ok, imgs = cv.imreadmulti(path, start = frame, count = 1,
+                                  flags = cv.IMREAD_ANYDEPTH)
+        if(not ok or len(imgs) == 0):
+            raise IOError("Could not read frame {} of {}".format(frame, path))
+        return imgs[0]
+
+    return np.array(page.asarray(), dtype = page.dtype.newbyteorder("="))